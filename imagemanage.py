@@ -17,7 +17,6 @@ A user can certainly create a mark action to do such a thing, however.
 """
 
 # TODO: README
-# TODO: Draw text on its own buffer
 # TODO: Support webm, webp
 # TODO: Support XPM (PIL breaks on images >1bpp)
 # TODO: Allow zoom adjustments (_ and +) to affect other scale modes
@@ -26,30 +25,45 @@ A user can certainly create a mark action to do such a thing, however.
 
 import argparse
 import collections
+import concurrent.futures
 import csv
+import ctypes
 import datetime
 import functools
+import hashlib
 import io
+import itertools
 import logging
 import mimetypes
+import operator
 import os
+import queue
 import random
 import shlex
+import stat
+import string
 import subprocess
 from subprocess import Popen, PIPE
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 import tkinter as tk
 import tkinter.font as tkfont
 
-from PIL import Image, ImageTk
+from PIL import Image, ImageDraw, ImageFont, ImageTk
 try:
   import cairosvg
   HAVE_CAIRO_SVG = True
 except ImportError:
   sys.stderr.write("cairosvg not found, svg support disabled\n")
   HAVE_CAIRO_SVG = False
+try:
+  import pyvips
+  HAVE_PYVIPS = True
+except (ImportError, OSError):
+  HAVE_PYVIPS = False
 
 class Logger(logging.Logger):
   "Logger with a TRACE level"
@@ -82,10 +96,34 @@ SORT_MODES = (
   SORT_TIME, SORT_RTIME,
   SORT_SIZE, SORT_RSIZE)
 
+# Sort argument -> (mode, key function, reverse?); see _parse_sort_arg()
+_SORT_TABLE = {
+  SORT_NONE: (SORT_NONE, None, False),
+  SORT_RAND: (SORT_RAND, None, False),
+  SORT_NAME: (SORT_NAME, None, False),
+  SORT_RNAME: (SORT_NAME, None, True),
+  SORT_TIME: (SORT_TIME, operator.attrgetter("mtime"), False),
+  SORT_RTIME: (SORT_TIME, operator.attrgetter("mtime"), True),
+  SORT_SIZE: (SORT_SIZE, operator.attrgetter("size"), False),
+  SORT_RSIZE: (SORT_SIZE, operator.attrgetter("size"), True),
+}
+
 SCALE_NONE = "none"     # leave images as they are
 SCALE_SHRINK = "shrink" # display the entire image
 SCALE_EXACT = "exact"   # resize the image to fill the canvas
 ZOOM_SCALE_PERCENT = 10 # Amount to scale the image using _ or +
+IMAGE_CACHE_SIZE = 32   # Number of loaded (and scaled) images to keep
+PREFETCH_OFFSETS = (1, -1, 10, -10) # Neighbors to load in the background
+SCAN_THREADS = 8        # Threads listing directories for --recurse
+RESIZE_DELAY = 100      # Milliseconds to wait for window resizing to settle
+LOAD_POLL_DELAY = 10    # Milliseconds between checks for a finished load
+TEXT_CACHE_SIZE = 256   # Number of images whose overlay text is kept
+DEFAULT_SAMPLE_METHOD = Image.BICUBIC # resample method until -s or :sample
+
+# Image modes that can be written to the thumbnail cache. Thumbnails are
+# stored as PNG so the cached copy is exactly what was scaled.
+THUMBNAIL_MODES = frozenset(("1", "L", "LA", "P", "RGB", "RGBA"))
+THUMBNAIL_PNG_LEVEL = 1 # zlib level for cached thumbnails; favors speed
 
 MODE_NONE = "none"
 MODE_RENAME = "rename"
@@ -97,12 +135,67 @@ MODE_LABEL = "label"
 MODE_COMMAND = "command"
 
 LINE_FORMAT = "{} {}\n" # default format of the program output
+TEXT_END = "---END---"  # persistent text programs end each reply with this
+TEXT_TIMEOUT = 5.0      # seconds to wait for a persistent program's reply
 
 INPUT_START_WIDTH = 20  # starting with of the input text box
 SCREEN_WIDTH_ADJ = 0    # pixels to subtract from window width
 SCREEN_HEIGHT_ADJ = 100 # pixels to subtract from window height (see FIXME)
 
 PADDING = 2             # padding around the input text box
+MARK_KEYS = frozenset("123456789") # keys that mark the current image
+
+# Image path along with the metadata used for sorting; see get_images()
+ImageRecord = collections.namedtuple("ImageRecord", ("path", "size", "mtime"))
+
+# statx(2) constants for fast_stat()
+AT_FDCWD = -100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_MTIME = 0x40
+STATX_SIZE = 0x200
+
+class _StatxTimestamp(ctypes.Structure):
+  "struct statx_timestamp"
+  _fields_ = [("tv_sec", ctypes.c_int64), ("tv_nsec", ctypes.c_uint32),
+      ("_reserved", ctypes.c_int32)]
+
+class _Statx(ctypes.Structure):
+  "struct statx, up to stx_mtime and padded to its full size"
+  _fields_ = [("stx_mask", ctypes.c_uint32), ("stx_blksize", ctypes.c_uint32),
+      ("stx_attributes", ctypes.c_uint64), ("stx_nlink", ctypes.c_uint32),
+      ("stx_uid", ctypes.c_uint32), ("stx_gid", ctypes.c_uint32),
+      ("stx_mode", ctypes.c_uint16), ("_spare0", ctypes.c_uint16),
+      ("stx_ino", ctypes.c_uint64), ("stx_size", ctypes.c_uint64),
+      ("stx_blocks", ctypes.c_uint64), ("stx_attributes_mask", ctypes.c_uint64),
+      ("stx_atime", _StatxTimestamp), ("stx_btime", _StatxTimestamp),
+      ("stx_ctime", _StatxTimestamp), ("stx_mtime", _StatxTimestamp),
+      ("_spare", ctypes.c_uint8 * 128)]
+
+def _get_statx():
+  "Return the libc statx() function, or None if it isn't available"
+  if not sys.platform.startswith("linux"):
+    return None
+  try:
+    func = ctypes.CDLL(None, use_errno=True).statx
+  except (OSError, AttributeError):
+    return None
+  func.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+      ctypes.c_uint, ctypes.POINTER(_Statx))
+  func.restype = ctypes.c_int
+  return func
+
+_statx = _get_statx()
+
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB") # units used by format_size
+
+# Filename extensions (lowercase) that mimetypes considers to be images
+mimetypes.init()
+IMAGE_EXTENSIONS = frozenset(ext.lower()
+    for ext, mtype in mimetypes.types_map.items()
+    if mtype.startswith("image/"))
+# Compressed images whose name ends in an encoding extension (lowercase);
+# mimetypes reports these as images too
+IMAGE_COMPRESSED_SUFFIXES = (".svg.gz",)
 
 # Constants affecting text formatting
 TF_INCREMENTAL = "incremental"
@@ -213,26 +306,76 @@ def read_images_file(path, relative=False):
 
 def format_size(nbytes, places=2):
   """Format a number of bytes into '<number> <scale>' string"""
-  bases = ["B", "KB", "MB", "GB", "TB", "PB"]
-  base = 0
-  curr = nbytes
-  while curr >= 1024 and base+1 < len(bases):
-    curr /= 1024.0
-    base += 1
+  # Each unit is 2**10 times the previous; pick it from the bit length
+  base = min(max(int(nbytes).bit_length() - 1, 0) // 10, len(SIZE_UNITS) - 1)
+  curr = nbytes / (1 << (10 * base)) if base > 0 else nbytes
   if places == 0:
     curr = int(curr)
   else:
     curr = round(curr, places)
-  return f"{curr} {bases[base]}"
+  return f"{curr} {SIZE_UNITS[base]}"
 
 def format_timestamp(tstamp, formatspec):
   """Format a numeric timestamp"""
   return datetime.datetime.fromtimestamp(tstamp).strftime(formatspec)
 
+def compile_line_format(lformat):
+  """
+  Convert an output line format string into a function taking the values to
+  format (the path and the action) and returning the formatted line
+
+  Formats using only positional fields, without conversions or format specs,
+  are parsed once here. Anything else falls back to calling str.format.
+  """
+  pieces = []
+  auto_index = 0
+  manual_field = False
+  for literal, field, spec, conv in string.Formatter().parse(lformat):
+    if literal:
+      pieces.append(literal)
+    if field is None:
+      continue
+    if spec or conv:
+      return lformat.format
+    if field == "":
+      pieces.append(auto_index)
+      auto_index += 1
+    elif field.isdigit():
+      pieces.append(int(field))
+      manual_field = True
+    else:
+      return lformat.format
+  if auto_index > 0 and manual_field:
+    return lformat.format # let str.format complain about the mixture
+  pieces = tuple(pieces)
+
+  def format_line(*values):
+    """Join the pre-parsed literals with the given values"""
+    return "".join([values[piece] if isinstance(piece, int) else piece
+        for piece in pieces])
+
+  return format_line
+
 def iterate_from(item_list, start_index):
   """Iterate once over thelist, cyclically, starting at the given index"""
-  yield from item_list[start_index:]
-  yield from item_list[:start_index]
+  # islice() streams the items rather than copying the list, so a search
+  # that stops early doesn't pay for the whole rotation
+  return itertools.chain(itertools.islice(item_list, start_index, None),
+      itertools.islice(item_list, 0, start_index))
+
+@functools.lru_cache(maxsize=None)
+def find_font_file(family, bold=False, italic=False):
+  """Locate the file for a font using fontconfig; None if that fails"""
+  weight = "bold" if bold else "regular"
+  slant = "italic" if italic else "roman"
+  pattern = f"{family}:weight={weight}:slant={slant}"
+  try:
+    out = subprocess.check_output(["fc-match", "--format=%{file}", pattern],
+        stderr=subprocess.DEVNULL)
+  except (OSError, subprocess.CalledProcessError) as err:
+    logger.debug("Failed to locate font %r: %s", pattern, err)
+    return None
+  return out.decode().strip() or None
 
 def get_mime_type(filepath):
   """Get the mimetype of the file as a pair (mimecat, mimevalue)"""
@@ -242,9 +385,29 @@ def get_mime_type(filepath):
     return mcat, mval
   return None, None
 
+def fast_stat(path, entry=None):
+  """
+  Return the (size, mtime) of a file. Uses statx() with AT_STATX_DONT_SYNC
+  where available, which lets network filesystems answer from their cached
+  attributes; this is only used to order images, so that's good enough.
+  Otherwise falls back to entry.stat() (for a DirEntry) or os.stat().
+  """
+  if _statx is not None:
+    buf = _Statx()
+    wanted = STATX_SIZE | STATX_MTIME
+    if _statx(AT_FDCWD, os.fsencode(path), AT_STATX_DONT_SYNC,
+        wanted, ctypes.byref(buf)) == 0:
+      if (buf.stx_mask & wanted) == wanted:
+        mtime = buf.stx_mtime.tv_sec + buf.stx_mtime.tv_nsec * 1e-9
+        return buf.stx_size, mtime
+  st = os.stat(path) if entry is None else entry.stat()
+  return st.st_size, st.st_mtime
+
 def is_image(filepath):
   """True if the string looks like it refers to an image file"""
-  return get_mime_type(filepath)[0] == "image"
+  lpath = filepath.lower()
+  return (os.path.splitext(lpath)[1] in IMAGE_EXTENSIONS
+      or lpath.endswith(IMAGE_COMPRESSED_SUFFIXES))
 
 def is_svg(filepath):
   """True if the path refers to an SVG file"""
@@ -269,6 +432,200 @@ def open_image(filepath):
     logger.error("Failed opening image %r: %s", filepath, err)
   return None
 
+def vips_thumbnail(path, size):
+  """
+  Shrink the image to fit within size using libvips, returning a PIL Image
+
+  For JPEGs, libvips shrinks while decoding and never materializes the full
+  resolution image. libvips always uses its own resampling kernel, so this
+  is only used with the default sample method. EXIF orientation is ignored,
+  like on the PIL path, so images display the same either way.
+  """
+  width, height = size
+  vimage = pyvips.Image.thumbnail(path, int(width), height=int(height),
+      size="down", no_rotate=True)
+  if vimage.interpretation not in ("srgb", "b-w"):
+    vimage = vimage.colourspace("srgb")
+  if vimage.format != "uchar":
+    vimage = vimage.cast("uchar")
+  mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[vimage.bands]
+  return Image.frombytes(mode, (vimage.width, vimage.height),
+      vimage.write_to_memory())
+
+def get_cache_dir():
+  """Get the default directory for cached thumbnails"""
+  cache_home = os.environ.get("XDG_CACHE_HOME")
+  if not cache_home:
+    cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(cache_home, "avtools", "thumbnails")
+
+def thumbnail_path(cache_dir, path, size, scale_mode, sample_method):
+  """
+  Get the path to the cached thumbnail of the image at the given size, scaled
+  with the given scale mode and sample method
+  """
+  key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+  width, height = size
+  return os.path.join(cache_dir,
+      f"{key}-{width}x{height}-{scale_mode}-{int(sample_method)}.png")
+
+def load_thumbnail(thumb_path, path):
+  """Load a cached thumbnail if it exists and is newer than the image"""
+  try:
+    if os.stat(thumb_path).st_mtime < os.stat(path).st_mtime:
+      return None
+    image = Image.open(thumb_path)
+    image.load()
+    return image
+  except OSError:
+    return None
+
+def save_thumbnail(image, thumb_path):
+  """Write a thumbnail to the cache, replacing any existing one"""
+  tmp_path = None
+  try:
+    # Write to a temporary file first; prefetch threads may race
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(thumb_path),
+        suffix=".tmp", delete=False) as fobj:
+      tmp_path = fobj.name
+      image.save(fobj, "PNG", compress_level=THUMBNAIL_PNG_LEVEL)
+    os.replace(tmp_path, thumb_path)
+  except OSError as err:
+    logger.warning("Failed to cache thumbnail %r: %s", thumb_path, err)
+    if tmp_path is not None and os.path.exists(tmp_path):
+      os.unlink(tmp_path)
+
+@functools.lru_cache(maxsize=None)
+def make_scaler(target_size, scale_mode, scale_amount=0):
+  """
+  Build a function mapping an image's (width, height) to the size to scale it
+  to, or None if it should be left alone. The canvas size and scale settings
+  rarely change, so the function for each combination is built only once.
+  """
+  target_w, target_h = target_size
+  def fit(image_w, image_h, fit_w, fit_h):
+    "Scale (image_w, image_h) to fit within (fit_w, fit_h)"
+    scale = max(image_w/fit_w, image_h/fit_h)
+    return int(image_w/scale), int(image_h/scale)
+
+  if scale_mode == SCALE_EXACT:
+    def scaled_size(image_size):
+      "Scale the image to fill the target"
+      if image_size == target_size:
+        return None
+      return fit(*image_size, target_w, target_h)
+  elif scale_mode == SCALE_SHRINK:
+    def scaled_size(image_size):
+      "Scale the image down to fit the target"
+      image_w, image_h = image_size
+      if image_w <= target_w and image_h <= target_h:
+        return None
+      return fit(image_w, image_h, target_w, target_h)
+  elif scale_mode == SCALE_NONE and scale_amount != 0:
+    factor = 1 + scale_amount / 100
+    def scaled_size(image_size):
+      "Scale the image by scale_amount percent"
+      image_w, image_h = image_size
+      return fit(image_w, image_h, image_w * factor, image_h * factor)
+  else:
+    scaled_size = lambda image_size: None
+  return scaled_size
+
+def load_scaled(path, frame_index, target_size, scale_mode, scale_amount=0,
+    sample_method=DEFAULT_SAMPLE_METHOD, cache_dir=None):
+  """
+  Load an image and scale it according to the scale mode and amount
+
+  Returns a triple (image, (real_width, real_height), frame_count), or
+  (None, None, 0) if the image can't be loaded. The image returned is a
+  single frame, so frame_count is how callers learn the image is animated.
+  Results are cached, so paging back and forth and redrawing at the same
+  size do not decode the file again; each call gets its own copy of the
+  cached image. If cache_dir is given, scaled images are also cached on disk
+  there.
+  """
+  image, real_size, frame_count = _load_scaled(path, frame_index,
+      target_size, scale_mode, scale_amount, sample_method, cache_dir)
+  if image is None:
+    return None, None, 0
+  return image.copy(), real_size, frame_count
+
+@functools.lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def _load_scaled(path, frame_index, target_size, scale_mode, scale_amount,
+    sample_method, cache_dir):
+  """
+  Implementation of load_scaled(). The images returned are shared by every
+  caller and are fully loaded and detached from their files.
+  """
+  image = open_image(path)
+  if image is None:
+    return None, None, 0
+  animated = is_animated(image)
+  frame_count = image.n_frames if animated else 1
+  if animated:
+    if 0 <= frame_index < image.n_frames:
+      image.seek(frame_index)
+
+  def detach(result):
+    "Release the source file; multi-frame images keep it open otherwise"
+    if result is image and animated:
+      result = image.copy()
+    if result is not image:
+      image.close()
+    return result
+
+  # Scale the image immediately
+  target_w, target_h = target_size
+  image_w, image_h = image.size
+  new_size = make_scaler(target_size, scale_mode, scale_amount)(image.size)
+  if new_size is None:
+    image.load() # decode now, possibly on a prefetch thread
+    return detach(image), (image_w, image_h), frame_count
+  new_w, new_h = new_size
+
+  thumb_path = None
+  if cache_dir is not None and not animated and image.mode in THUMBNAIL_MODES:
+    thumb_path = thumbnail_path(cache_dir, path, (new_w, new_h), scale_mode,
+        sample_method)
+  if thumb_path is not None:
+    thumb = load_thumbnail(thumb_path, path)
+    if thumb is not None:
+      logger.debug("Loaded %r from cached %r", path, thumb_path)
+      return detach(thumb), (image_w, image_h), frame_count
+
+  scaled = None
+  # libvips can't honor a specific sampler, so leave those to PIL
+  use_vips = (HAVE_PYVIPS and image.format == "JPEG"
+      and sample_method == DEFAULT_SAMPLE_METHOD)
+  if scale_mode == SCALE_SHRINK and use_vips:
+    try:
+      scaled = vips_thumbnail(path, (target_w, target_h))
+      logger.debug("Shrank %r [%d,%d] to [%d,%d] via libvips",
+          path, image_w, image_h, *scaled.size)
+    except pyvips.Error as err:
+      logger.warning("libvips failed on %r: %s; using PIL", path, err)
+
+  if scaled is None and scale_mode == SCALE_SHRINK:
+    # thumbnail() drafts JPEGs itself and, by default, reduces in integer
+    # steps before the final resample
+    image.thumbnail((target_w, target_h), sample_method)
+    scaled = image
+    logger.debug("Shrank %r [%d,%d] to [%d,%d] (to fit %d %d)",
+        path, image_w, image_h, *scaled.size, target_w, target_h)
+
+  if scaled is None:
+    logger.debug("Scale %r [%d,%d] to [%d,%d] (to fit %d %d)",
+        path, image_w, image_h, new_w, new_h, target_w, target_h)
+    if new_w < image_w and image.format == "JPEG":
+      # Have libjpeg decode at 1/2, 1/4, or 1/8 scale when that's enough
+      image.draft(None, (new_w, new_h))
+    scaled = image.resize((new_w, new_h), sample_method)
+
+  if thumb_path is not None and scaled.mode in THUMBNAIL_MODES:
+    save_thumbnail(scaled, thumb_path)
+
+  return detach(scaled), (image_w, image_h), frame_count
+
 def _parse_format_token(token):
   """
   Parse a single keyi or key-value formatting token. Valid tokens are:
@@ -383,7 +740,7 @@ def _blocked_by_input(func): # decorator-generator
   @functools.wraps(func)
   def wrapper(self, *args, **kwargs):
     # pylint: disable=protected-access
-    if self.root.focus_get() != self._input:
+    if not self._input_focused:
       return func(self, *args, **kwargs)
     logger.trace("Input has focus; blocking event")
     return None
@@ -404,7 +761,8 @@ class ImageManager:
   font_family: input and text font (default: monospace)
   font_size: input and text font size (default: 10)
   input_width: width of input box (in characters)
-  icon: path to an icon to use for the system tray
+  icon: path to (or opened PIL Image of) an icon to use for the system tray
+  cache_dir: if given, cache scaled images in this directory
   """
 
   def __init__(self, images,
@@ -414,17 +772,24 @@ class ImageManager:
       font_family=FONT,
       font_size=FONT_SIZE,
       input_width=INPUT_START_WIDTH,
-      icon=None):
+      icon=None,
+      cache_dir=None):
     self._output = []
+    self._output_files = {}     # path -> open (line-buffered) file object
+    self._cache_dir = cache_dir
     self._root = root = tk.Tk()
     root.title("Image Manager") # Default; overwritten shortly with image info
-    if icon:
-      root.iconphoto(False, ImageTk.PhotoImage(Image.open(icon)))
+    if icon is not None:
+      if not isinstance(icon, Image.Image):
+        icon = Image.open(icon)
+      root.iconphoto(False, ImageTk.PhotoImage(icon))
 
     # Bind to all relevant top-level events
     root.bind_all("<Key-Escape>", self.escape)
     root.bind_all("<Control-Key-w>", self.close)
     root.bind_all("<Control-Key-q>", self.close)
+    # Closing the window goes through close() so everything is cleaned up
+    root.protocol("WM_DELETE_WINDOW", lambda: self.close(None))
     root.bind_all("<Key-Left>", self._prev_image)
     root.bind_all("<Key-Right>", self._next_image)
     root.bind_all("<Key-Up>", self._next_many)
@@ -454,8 +819,6 @@ class ImageManager:
     root.bind_all("<ButtonPress-3>", self._on_mouse_right)
     root.bind_all("<MouseWheel>", self._on_mouse_scroll)
     root.bind("<Configure>", self._update_window)
-    for i in range(1, 10):
-      root.bind_all(f"<Key-{i}>", self._mark_image)
 
     # Configuration before widget construction: root geometry
     if width is None:
@@ -465,6 +828,8 @@ class ImageManager:
     self._width = width
     self._height = height
     root.geometry(f"{self._width}x{self._height}")
+    self._resize_after = None   # Pending resize timer (see _update_window)
+    self._resize_to = (width, height)
 
     self._enable_text = show_text
     self._text_functions = []
@@ -480,6 +845,7 @@ class ImageManager:
     self._font_family = font_family
     self._font_size = font_size
     self._font_cache = {}
+    self._pil_font_cache = {}
     self._font = None
     self._font = self._get_font(bold=False)
 
@@ -493,7 +859,7 @@ class ImageManager:
     self._null_menu = tk.Menu(root) # Used to hide the menu bar
     self._menu = tk.Menu(root)
     menu_file = tk.Menu(self._menu, tearoff=0)
-    menu_file.add_command(label="Exit", command=root.quit)
+    menu_file.add_command(label="Exit", command=lambda: self.close(None))
     self._menu.add_cascade(label="File", menu=menu_file)
     menu_view = tk.Menu(self._menu, tearoff=0)
     menu_view.add_command(label="Reset Image",
@@ -515,12 +881,22 @@ class ImageManager:
     self._canvas.grid(row=0, column=0)
     self._gutter.lower(self._canvas)
 
+    # The image and the text overlay are persistent canvas items that are
+    # updated in place by _draw_current()
+    self._photo_item = self._canvas.create_image(0, 0, anchor=tk.CENTER)
+    self._text_item = self._canvas.create_image(0, 0, anchor=tk.NW,
+        state=tk.HIDDEN)
+
     # IDs of temporary objects to remove as soon as the user requests
     self._canvas_temp = []
 
     # Text drawn on top of the image
     self._text_lines = []
     self._text_ids = []
+    # path -> ((mtime, size), text lines), least recently used first
+    self._text_cache = collections.OrderedDict()
+    self._text_photo_key = None # what the current text overlay shows
+    self._text_photo = None     # PhotoImage reference for the text overlay
 
     # Create primary input box (which starts hidden)
     self._input_mode = MODE_NONE
@@ -531,17 +907,34 @@ class ImageManager:
     self._input.grid(row=0, column=0, sticky=tk.NW)
     self._input.bind("<Key-Return>", self._input_enter)
     self._input.lower(self._canvas)
+    # Track the input's focus here rather than asking Tk on every keypress
+    self._input_focused = False
+    self._input.bind("<FocusIn>", lambda *_: self._set_input_focused(True))
+    self._input.bind("<FocusOut>", lambda *_: self._set_input_focused(False))
 
     # Image list and current image objects
     self._images = list(images) # Loaded images
     self._count = len(self._images) # Total number of images
+    self._basenames = [os.path.basename(p) for p in self._images]
+    self._failed = []           # Images removed because they failed to load
     self._index = 0             # Current image index
-    self._image = None          # Current PIL.Image object
+    self._image = None          # Current PIL.Image object (a single frame)
+    self._frame_count = 1       # Number of frames in the current image
     self._photo = None          # Tkinter PhotoImage reference
     self._playing = False       # If we are currently playing a GIF
     self._frame_index = 0       # Current frame index when playing a GIF
     self._frame_delay = 100     # Frame delay in milliseconds (10 fps)
-    self._sample_method = Image.BICUBIC # rescale resample method
+    self._sample_method = DEFAULT_SAMPLE_METHOD # rescale resample method
+
+    # Neighboring images are loaded on worker threads. Only PIL is touched
+    # there; everything involving Tk stays on the main thread.
+    # Prefetches get their own pool so they never delay the image on screen.
+    self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    self._prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self._pending_loads = {}    # load_scaled() arguments -> prefetch Future
+    self._prefetch_index = None # Index whose neighbors were last prefetched
+    self._loading = None        # Future for the image about to be shown
+    self._loading_index = None  # Index of the image about to be shown
 
     # Canvas dimensions
     self.set_canvas_size((self._width, self._height))
@@ -552,7 +945,7 @@ class ImageManager:
     self._keybinds = collections.defaultdict(list)
     self._actions = collections.defaultdict(list)
     self._functions = collections.defaultdict(list)
-    self._mark_functions = {}
+    self._mark_paths = collections.defaultdict(list)
 
     self._root.after(self._frame_delay, lambda *_: self._on_frame_tick())
 
@@ -566,13 +959,25 @@ class ImageManager:
 
   root = property(lambda self: self._root)
 
-  def add_output_file(self, path, lformat=LINE_FORMAT):
-    """Write mark actions to the given path"""
-    self._output.append({"path": path, "line_format": lformat})
+  def add_output_file(self, path, lformat=LINE_FORMAT, truncate=False):
+    """
+    Write mark actions to the given path
 
-  def add_mark_function(self, key, cbfunc):
-    """Add callback function for when mark key (1..9) is pressed"""
-    self._mark_functions[key] = cbfunc
+    lformat is either a format string or a function returned by
+    compile_line_format(). If truncate is True, the file is emptied now;
+    otherwise actions are appended to it.
+    """
+    if isinstance(lformat, str):
+      lformat = compile_line_format(lformat)
+    if truncate:
+      # Keep the file open; later writes go through _get_output_file()
+      self._output_files[path] = open(path, "wt", buffering=1)
+    self._output.append({"path": path, "format_line": lformat})
+
+  def add_mark_path(self, key, path):
+    """Write the current image path to path when mark key is pressed"""
+    logger.debug("Writing images to %r on MARK-%s", path, key)
+    self._mark_paths[key].append(path)
 
   def add_key_function(self, key, cbfunc):
     """Add a callback function when any key is pressed"""
@@ -585,6 +990,7 @@ class ImageManager:
   def add_text_function(self, func):
     """Call func(path) and display the result on the image"""
     self._text_functions.append(func)
+    self._text_cache.clear()
 
   def register_command(self, command, func):
     """
@@ -621,7 +1027,70 @@ class ImageManager:
     return fpath
 
   def set_index(self, index, recenter=True, skip_text=None):
-    """Sets the index and displays the image at that index"""
+    """
+    Sets the index and displays the image at that index.
+
+    The image is decoded on a worker thread; it is displayed once loaded,
+    unless another image was requested in the meantime.
+    """
+    key = self._load_args(self._images[index])
+    future = self._pending_loads.pop(key, None)
+    if future is not None and future.cancel():
+      # Still queued behind other prefetches; load it right away instead
+      future = None
+    if future is None:
+      future = self._io_pool.submit(load_scaled, *key)
+    self._cancel_prefetches(index)
+    if self._loading is not None and not self._loading.done():
+      # Don't make the requested image wait behind one nobody wants now
+      self._loading.cancel()
+    self._loading = future
+    self._loading_index = index
+    self._poll_load(future, index, recenter, skip_text)
+
+  def _target_index(self):
+    """Index of the image being shown or about to be shown"""
+    if self._loading_index is not None:
+      return self._loading_index
+    return self._index
+
+  def _poll_load(self, future, index, recenter, skip_text):
+    """Display the image once its load finishes, ignoring stale loads"""
+    if future is not self._loading or future.cancelled():
+      return
+    if not future.done():
+      self._root.after(LOAD_POLL_DELAY,
+          self._poll_load, future, index, recenter, skip_text)
+      return
+    self._loading = None
+    self._loading_index = None
+
+    # Images are not verified up front; drop any that fail to load here and
+    # show the next one instead
+    image, real_size, frame_count = future.result()
+    if image is None:
+      logger.error("Failed to load %r; removing it", self._images[index])
+      self._failed.append(self._images.pop(index))
+      self._basenames.pop(index)
+      self._count -= 1
+      if index < self._index:
+        self._index -= 1
+      if self._loading_index is not None and index < self._loading_index:
+        self._loading_index -= 1
+      if self._count == 0:
+        logger.error("No images left to display!")
+        self._canvas.delete(tk.ALL)
+        self.root.title("ERROR! No images left to display")
+        self._root.after_idle(self.close, None)
+        return
+      self.set_index(index % self._count, recenter=recenter,
+          skip_text=not self._enable_text)
+      return
+    self._show_image(index, image, real_size, frame_count, recenter, skip_text)
+
+  def _show_image(self, index, image, real_size, frame_count, recenter,
+      skip_text):
+    """Display a loaded image; see set_index()"""
     if recenter:
       self._center_offset = [0, 0]
 
@@ -634,29 +1103,36 @@ class ImageManager:
       else:
         skip_text = False
 
+    self._real_width, self._real_height = real_size
     self._index = index
+    self._image = image
+    self._frame_count = frame_count
     path = self._images[index]
 
     actions = f"{recenter=} {skip_text=}"
     logger.debug("Image %d/%d %r %s", index+1, self._count, path, actions)
 
     new_title = f"{index+1}/{self._count} {path}"
-    self._image = self._get_image(path)
-    if self._image is not None:
-      self._draw_current(skip_text=skip_text)
-    else:
-      logger.error("Failed to load %r!", path)
-      new_title = "ERROR! " + new_title
-      self._canvas.delete(tk.ALL)
+    self._draw_current(skip_text=skip_text)
 
     if self._playing:
       new_title += " (playing)"
 
     self.root.title(new_title)
+    # Redraws (animation, resizing, zooming) don't need new neighbors
+    if index != self._prefetch_index:
+      self._prefetch(index)
 
   def redraw(self, recenter=True, skip_text=None):
-    """Recomputes and redraws the current image"""
-    self.set_index(self._index, recenter=recenter, skip_text=skip_text)
+    """
+    Recomputes and redraws the current image. If another image is still
+    loading, that image is redrawn instead so the navigation isn't lost.
+    """
+    index = self._target_index()
+    if index != self._index:
+      # The cached text belongs to the image being replaced
+      skip_text = None
+    self.set_index(index, recenter=recenter, skip_text=skip_text)
 
   def hide_input(self): # TODO: move text up
     """Hide the input box"""
@@ -708,10 +1184,14 @@ class ImageManager:
     ids.append(draw_string(posx, posy, fgcolor))
     return ids
 
+  def _set_input_focused(self, focused):
+    """Record whether the input box has keyboard focus"""
+    self._input_focused = focused
+
   # Tkinter callback
   def escape(self, event):
     """Either cancel rename or exit the application"""
-    if self._root.focus_get() == self._input:
+    if self._input_focused:
       self._input_mode = MODE_NONE
       self._input.delete(0, len(self._input.get()))
       self._gutter.focus()
@@ -721,51 +1201,73 @@ class ImageManager:
   # Tkinter callback
   def close(self, event):
     """Exit the application"""
+    if self._failed:
+      logger.warning("Skipped %d image(s) that failed to load:",
+          len(self._failed))
+      for path in self._failed:
+        logger.warning("  %s", path)
+      self._failed = []
+    self._close_output_files()
+    for func in self._text_functions:
+      # Persistent text programs (TextWorker) need to be stopped
+      if hasattr(func, "close"):
+        func.close()
+    self._io_pool.shutdown(wait=False, cancel_futures=True)
+    self._prefetch_pool.shutdown(wait=False, cancel_futures=True)
     self.root.quit()
 
+  def _get_output_file(self, path):
+    """
+    Return the file object for appending to path, opening it on first use.
+    Files are line-buffered so each written line reaches the disk at once.
+    """
+    fobj = self._output_files.get(path)
+    if fobj is None:
+      logger.trace("open(%r, 'at')", path)
+      fobj = self._output_files[path] = open(path, "at", buffering=1)
+    return fobj
+
+  def _close_output_files(self):
+    """Close the files opened by _get_output_file()"""
+    for path, fobj in self._output_files.items():
+      try:
+        fobj.close()
+      except OSError as err:
+        logger.error("Failed to close %r: %s", path, err)
+    self._output_files = {}
+
   def _resize_input(self, text):
     """Ensure the input is wide enough to display the text"""
     min_chrs = max(len(text), INPUT_START_WIDTH)
     max_chrs = int(round(self._width / self.char_width()))
     self._input["width"] = min(min_chrs, max_chrs)
 
-  def _get_image(self, path):
-    """Load (and optionally resize) image specified by path"""
-    image = open_image(path)
-    if image is None:
-      logger.error("Failed to load image")
-      return None
-
-    if is_animated(image):
-      if 0 <= self._frame_index < image.n_frames:
-        image.seek(self._frame_index)
-
-    # Scale the image immediately
-    target_w, target_h = self._width, self._height
-    image_w, image_h = image.size
-    self._real_width = image_w
-    self._real_height = image_h
-    want_scale = False
-    if self._scale_mode == SCALE_EXACT:
-      if (image_w, image_h) != (target_w, target_h):
-        want_scale = True
-    elif self._scale_mode == SCALE_SHRINK:
-      if image_w > target_w or image_h > target_h:
-        want_scale = True
-    elif self._scale_mode == SCALE_NONE and self._scale_amount != 0:
-      target_w, target_h = image_w, image_h
-      target_w += target_w * self._scale_amount / 100
-      target_h += target_h * self._scale_amount / 100
-      want_scale = True
-
-    if want_scale:
-      scale = max(image_w/target_w, image_h/target_h)
-      new_w, new_h = int(image_w/scale), int(image_h/scale)
-      logger.debug("Scale %r [%d,%d] by %f to [%d,%d] (to fit %d %d)",
-          path, image_w, image_h, scale, new_w, new_h, target_w, target_h)
-      image = image.resize((new_w, new_h), self._sample_method)
-
-    return image
+  def _load_args(self, path):
+    """Arguments to load_scaled() for displaying path in the current state"""
+    return (path,
+        self._frame_index,
+        (self._width, self._height),
+        self._scale_mode,
+        self._scale_amount,
+        self._sample_method,
+        self._cache_dir)
+
+  def _prefetch(self, index):
+    """Start loading the images near index in the background"""
+    self._prefetch_index = index
+    for offset in PREFETCH_OFFSETS:
+      key = self._load_args(self._images[(index + offset) % self._count])
+      if key not in self._pending_loads:
+        self._pending_loads[key] = self._prefetch_pool.submit(load_scaled, *key)
+
+  def _cancel_prefetches(self, index):
+    """Cancel and forget prefetches that aren't for neighbors of index"""
+    neighbors = {self._images[(index + offset) % self._count]
+        for offset in PREFETCH_OFFSETS}
+    for key, future in list(self._pending_loads.items()):
+      if future.done() or key[0] not in neighbors:
+        future.cancel()
+        del self._pending_loads[key]
 
   def _get_font(self,
       bold=True,        # Use bold weight over normal
@@ -789,6 +1291,114 @@ class ImageManager:
       font = self._font_cache[cache_key]
     return font
 
+  def _get_pil_font(self,
+      bold=True,        # Use bold weight over normal
+      italic=False,     # Use italic slant over roman
+      size=None,        # Use custom size (None -> self._font_size)
+      family=None):     # Use custom font face (None -> self._font_family)
+    """
+    Obtain a PIL font matching _get_font() and cache it for future use.
+    Returns None if the font file can't be found or loaded.
+    """
+    cache_key = (bold, italic, size, family)
+    if cache_key not in self._pil_font_cache:
+      ffamily = self._font_family if family is None else family
+      fsize = self._font_size if size is None else size
+      font = None
+      font_file = find_font_file(ffamily, bool(bold), bool(italic))
+      if font_file is not None:
+        # Tk sizes are in points; negative sizes are in pixels
+        if fsize < 0:
+          pixels = -fsize
+        else:
+          pixels = round(self._root.winfo_fpixels(f"{fsize}p"))
+        try:
+          font = ImageFont.truetype(font_file, pixels)
+        except OSError as err:
+          logger.warning("Failed to load font %r: %s", font_file, err)
+      self._pil_font_cache[cache_key] = font
+    return self._pil_font_cache[cache_key]
+
+  def _get_rgb(self, color):
+    """Convert a Tk color specification to an (r, g, b) triple"""
+    return tuple(val >> 8 for val in self._root.winfo_rgb(color))
+
+  def _render_text_block(self, lines, incremental=False, **kwargs):
+    """
+    Render several lines of text, with drop shadows, to an RGBA image.
+
+    Accepts the same formatting as _draw_text_lines(). Returns None if a
+    needed font isn't available to PIL.
+    """
+    fgcolor = kwargs.get("fgcolor", "white")
+    bgcolor = kwargs.get("bgcolor", "black")
+    border = kwargs.get("border", 1)
+    get_rule = lambda table, rule, default=None: \
+        table.get(rule, kwargs.get(rule, default))
+
+    # Lay out the text first to determine the size of the image
+    pieces = []
+    width, height = 0, 0
+    default_font = self._get_pil_font()
+    if default_font is None:
+      return None
+    for line in lines:
+      linex = 0
+      ascent, descent = default_font.getmetrics()
+      line_height = ascent + descent
+      for format_rules, text in parse_formatted_text(line, incremental):
+        font = self._get_pil_font(
+            get_rule(format_rules, TF_BOLD, True),
+            get_rule(format_rules, TF_ITALIC, False),
+            get_rule(format_rules, TF_SIZE),
+            get_rule(format_rules, TF_FONT))
+        if font is None:
+          return None
+        pieces.append((linex, height, text, font,
+            self._get_rgb(get_rule(format_rules, TF_FGCOLOR, fgcolor)),
+            self._get_rgb(get_rule(format_rules, TF_BGCOLOR, bgcolor))))
+        ascent, descent = font.getmetrics()
+        line_height = max(line_height, ascent + descent)
+        linex += font.getlength(text)
+      width = max(width, linex)
+      height += line_height
+
+    image = Image.new("RGBA",
+        (int(width) + 1 + 2*border, height + 2*border), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    shadow_offsets = ((-border, -border), (-border, border),
+        (border, -border), (border, border))
+    for textx, texty, text, font, fgrgb, bgrgb in pieces:
+      textx += border
+      texty += border
+      for offx, offy in shadow_offsets:
+        draw.text((textx+offx, texty+offy), text, font=font, fill=bgrgb)
+      draw.text((textx, texty), text, font=font, fill=fgrgb)
+    return image
+
+  def _draw_text_block(self, lines, pos=(0, 0), shiftx=2, shifty=2, border=1):
+    """
+    Draw several lines of text as a single pre-rendered image, falling back
+    to _draw_text_lines() if PIL can't render the font. Returns the Tkinter
+    IDs for the items created.
+    """
+    # Redraws of the same image (resizing, panning) reuse the overlay
+    render_key = (tuple(lines), self._font_family, self._font_size, border)
+    if render_key != self._text_photo_key or self._text_photo is None:
+      image = self._render_text_block(lines, border=border)
+      if image is None:
+        return self._draw_text_lines(lines, pos=pos,
+            shiftx=shiftx, shifty=shifty, border=border)
+      # Keep a reference; see the note in _draw_current
+      self._text_photo = ImageTk.PhotoImage(image)
+      self._text_photo_key = render_key
+    photo = self._text_photo
+    posx = pos[0] + shiftx - border
+    posy = pos[1] + self._input_height + shifty - border
+    self._canvas.itemconfigure(self._text_item, image=photo, state=tk.NORMAL)
+    self._canvas.coords(self._text_item, posx, posy)
+    return [self._text_item]
+
   def _draw_text_lines(self, lines, pos=(0, 0), incremental=False, **kwargs):
     """
     Draw several lines of text.
@@ -814,6 +1424,49 @@ class ImageManager:
         linex += font.measure(text)
     return oids
 
+  def _get_text_lines(self, path):
+    """
+    Build the text displayed over the image at path
+
+    The result is cached until the file's mtime or size changes, so returning
+    to an image doesn't re-run the text functions (which may run external
+    programs). Only the TEXT_CACHE_SIZE most recently shown images are kept.
+    Redrawing the image already shown reuses its text without calling this.
+    """
+    st = os.stat(path)
+    stat_key = (st.st_mtime, st.st_size)
+    cached = self._text_cache.get(path)
+    if cached is not None and cached[0] == stat_key:
+      self._text_cache.move_to_end(path)
+      return list(cached[1])
+
+    # Add standard text for path, size, and filetime
+    text_lines = [os.path.basename(path)]
+
+    realw, realh = self._real_width, self._real_height
+    size = format_size(st.st_size)
+    text_lines.append(f"Size: {size}; {realw}x{realh}px")
+    #imgw, imgh = self._image.size
+    #if (imgw, imgh) != (realw, realh):
+    #  text_lines.append(f"Resized to {imgw}x{imgh}px")
+
+    tstamp = format_timestamp(st.st_mtime, "%Y/%m/%d %H:%M:%S")
+    text_lines.append(f"Time: {tstamp}")
+
+    # Call the text functions to add whatever they want
+    for func in self._text_functions:
+      text = func(path)
+      # Ensure text is actually a string (and not a bytes type)
+      if not isinstance(text, str) and hasattr(text, "decode"):
+        text = text.decode()
+      text_lines.extend(text.splitlines())
+
+    self._text_cache[path] = (stat_key, tuple(text_lines))
+    self._text_cache.move_to_end(path)
+    if len(self._text_cache) > TEXT_CACHE_SIZE:
+      self._text_cache.popitem(last=False)
+    return text_lines
+
   def _draw_current(self, skip_text=False):
     """Draw self._image to self._canvas"""
     path = self._images[self._index]
@@ -821,41 +1474,27 @@ class ImageManager:
     # does not properly take ownership of the reference and the PhotoImage
     # object ends up being deallocated almost immediately.
     self._photo = ImageTk.PhotoImage(self._image)
-    self._canvas.delete(tk.ALL)
-    self._canvas.create_image(
+    self._canvas_clear_temp()
+    self._canvas.itemconfigure(self._photo_item, image=self._photo)
+    self._canvas.coords(self._photo_item,
         self._width/2 + self._center_offset[0],
-        self._height/2 + self._center_offset[1],
-        image=self._photo,
-        anchor=tk.CENTER)
+        self._height/2 + self._center_offset[1])
 
     text_lines = list(self._text_lines)
     if not self._enable_text:
       text_lines = []
     elif not skip_text:
-      # Add standard text for path, size, and filetime
-      text_lines = [os.path.basename(path)]
-
-      realw, realh = self._real_width, self._real_height
-      stat = os.stat(path)
-      size = format_size(stat.st_size)
-      text_lines.append(f"Size: {size}; {realw}x{realh}px")
-      #imgw, imgh = self._image.size
-      #if (imgw, imgh) != (realw, realh):
-      #  text_lines.append(f"Resized to {imgw}x{imgh}px")
-
-      tstamp = format_timestamp(stat.st_mtime, "%Y/%m/%d %H:%M:%S")
-      text_lines.append(f"Time: {tstamp}")
-
-      # Call the text functions to add whatever they want
-      for func in self._text_functions:
-        text = func(path)
-        # Ensure text is actually a string (and not a bytes type)
-        if not isinstance(text, str) and hasattr(text, "decode"):
-          text = text.decode()
-        text_lines.extend(text.splitlines())
+      text_lines = self._get_text_lines(path)
 
+    # Remove text drawn as individual items (see _draw_text_block)
+    old_ids = [item for item in self._text_ids if item != self._text_item]
+    if old_ids:
+      self._canvas.delete(*old_ids)
     if text_lines:
-      self._text_ids = self._draw_text_lines(text_lines)
+      self._text_ids = self._draw_text_block(text_lines)
+    else:
+      self._canvas.itemconfigure(self._text_item, state=tk.HIDDEN)
+      self._text_ids = []
     self._text_lines = list(text_lines)
 
   def _action(self, *args):
@@ -868,13 +1507,14 @@ class ImageManager:
       action = args[1]
     else:
       raise ValueError(f"invalid arguments to _action; got {args!r}")
+    # Verbs come from a tiny vocabulary; share one string object per verb
+    action = (sys.intern(action[0]), *action[1:])
     logger.info("%s: %s", path, " ".join(action))
     self._actions[path].append(action)
     for oentry in self._output:
-      fpath = oentry["path"]
-      lformat = oentry["line_format"]
-      with open(fpath, "at") as fobj:
-        fobj.write(lformat.format(path, " ".join(action)))
+      format_line = oentry["format_line"]
+      fobj = self._get_output_file(oentry["path"])
+      fobj.write(format_line(path, " ".join(action)))
 
   def _input_set_text(self, text, select=True):
     """Set the input box's text, optionally selecting the content"""
@@ -887,20 +1527,20 @@ class ImageManager:
       self._input.select_range(0, len(text))
 
   def _do_find_image(self, prefix):
-    """Return the path to the next image starting with prefix, if found"""
-    for image_path in iterate_from(self._images, self._index + 1):
-      name = os.path.basename(image_path)
+    """Return the index of the next image starting with prefix, if found"""
+    start = self._target_index() + 1
+    for offset, name in enumerate(iterate_from(self._basenames, start)):
       if name.startswith(prefix):
-        return image_path
+        return (start + offset) % self._count
     return None
 
   # Tkinter callback
   def _on_frame_tick(self):
     """Called to advance a frame in an animated image"""
     if self._playing:
-      if is_animated(self._image):
+      if self._frame_count > 1:
         self._frame_index += 1
-        if self._frame_index >= self._image.n_frames:
+        if self._frame_index >= self._frame_count:
           self._frame_index = 0
         self.redraw(skip_text=True)
     self._root.after(self._frame_delay, lambda *_: self._on_frame_tick())
@@ -916,7 +1556,11 @@ class ImageManager:
   def _on_keypress(self, event):
     """Called when any key is pressed"""
     logger.debug("Received keypress %r", event)
-    if self._keybinds.get(event.keysym):
+    if event.char in MARK_KEYS:
+      self._mark_image(event)
+      return
+    # Keybinds describe the current image; there isn't one until it loads
+    if self._image is not None and self._keybinds.get(event.keysym):
       format_keys = dict(
         file=self.path(),
         index=self._index,
@@ -998,6 +1642,13 @@ class ImageManager:
     """Called when the mouse scroll wheel is used (does not work on Linux)"""
     logger.trace("Scroll %s", event)
 
+  def _write_mark_paths(self, key):
+    """Append the current image path to the files registered for the key"""
+    image_path = self.path()
+    for path in self._mark_paths[key]:
+      logger.trace("Writing %r to %r", image_path, path)
+      self._get_output_file(path).write(image_path + os.linesep)
+
   def _canvas_clear_temp(self):
     """Delete temporary items drawn on the canvas"""
     for item in self._canvas_temp:
@@ -1007,22 +1658,22 @@ class ImageManager:
   @_blocked_by_input # Tkinter callback and manual call
   def _next_image(self, event):
     """Navigate to the next image"""
-    self.set_index((self._index + 1) % self._count)
+    self.set_index((self._target_index() + 1) % self._count)
 
   @_blocked_by_input # Tkinter callback and manual call
   def _prev_image(self, event):
     """Navigate to the previous image"""
-    self.set_index((self._index - 1) % self._count)
+    self.set_index((self._target_index() - 1) % self._count)
 
   @_blocked_by_input # Tkinter callback
   def _next_many(self, event):
     """Navigate to the 10th next image"""
-    self.set_index((self._index + 10) % self._count)
+    self.set_index((self._target_index() + 10) % self._count)
 
   @_blocked_by_input # Tkinter callback
   def _prev_many(self, event):
     """Navigate to the 10th previous image"""
-    self.set_index((self._index - 10) % self._count)
+    self.set_index((self._target_index() - 10) % self._count)
 
   @_blocked_by_input # Tkinter callback
   def _next_some(self, event):
@@ -1063,8 +1714,8 @@ class ImageManager:
   @_blocked_by_input # Tkinter callback
   def _mark_image(self, event):
     """Mark an image for later examination"""
-    if event.char in self._mark_functions:
-      self._mark_functions[event.char](self.path())
+    if event.char in self._mark_paths:
+      self._write_mark_paths(event.char)
     self._action((f"MARK-{event.char}",))
 
   @_blocked_by_input # Tkinter callback
@@ -1147,12 +1798,24 @@ class ImageManager:
     """Called when the root window receives a Configure event"""
     logger.trace("_update_window on %r: %s", event.widget, event)
     if event.widget == self._root:
-      width, height = self._width, self._height
-      self._width = event.width
-      self._height = event.height
-      # Inhibit redraw if scaling is less than a certain amount
-      if abs(width-self._width) > 2 or abs(height-self._height) > 2:
-        self.redraw(recenter=False)
+      new_size = (event.width, event.height)
+      if self._resize_after is None and new_size == (self._width, self._height):
+        return
+      # Dragging the window edge sends a storm of events; only redraw once
+      # the size has stopped changing
+      self._resize_to = new_size
+      if self._resize_after is not None:
+        self._root.after_cancel(self._resize_after)
+      self._resize_after = self._root.after(RESIZE_DELAY, self._do_resize)
+
+  def _do_resize(self):
+    """Apply the most recent window size, redrawing if needed"""
+    self._resize_after = None
+    width, height = self._width, self._height
+    self._width, self._height = self._resize_to
+    # Inhibit redraw if scaling is less than a certain amount
+    if abs(width-self._width) > 2 or abs(height-self._height) > 2:
+      self.redraw(recenter=False)
 
   def _do_input_rename(self, value):
     """Handle the rename input"""
@@ -1166,9 +1829,9 @@ class ImageManager:
 
   def _do_input_goto(self, value):
     """Handle the go-to-image-by-search input"""
-    next_image = self._do_find_image(value)
-    if next_image is not None:
-      self.set_index(self._images.index(next_image))
+    next_index = self._do_find_image(value)
+    if next_index is not None:
+      self.set_index(next_index)
     else:
       logger.error("Pattern %r not found", value)
 
@@ -1188,7 +1851,7 @@ class ImageManager:
       delta = int(value)
       if negative:
         delta = -delta
-      index = (self._index + delta) % self._count
+      index = (self._target_index() + delta) % self._count
       logger.info("Navigating to image number %d", index)
       self.set_index(index)
     except ValueError as err:
@@ -1295,19 +1958,93 @@ class ImageManager:
       logger.error("Internal error: invalid mode %s; value=%r args=%r",
           mode, value, args)
 
-def get_images(*paths, recursive=False, quick=False, cont_on_error=False):
-  """Return a list of all images found in the given paths"""
+def _can_open(path):
+  """Return the path if PIL can open the image, None otherwise"""
+  try:
+    image = open_image(path)
+  except ValueError as err:
+    logger.error("Failed to open image %r: %s", path, err)
+    return None
+  if image is None:
+    return None
+  image.close()
+  return path
+
+def get_images(*paths, recursive=False, quick=False, cont_on_error=False,
+    with_stat=False):
+  """
+  Return a list of all images found in the given paths. If with_stat is
+  True, return a list of ImageRecords instead.
+  """
+  def make_item(path, entry=None):
+    "Build the list item for an image; None if it can't be stat'd"
+    if not with_stat:
+      return path
+    try:
+      size, mtime = fast_stat(path, entry)
+    except OSError as err:
+      logger.error("Failed to stat %r: %s", path, err)
+      return None
+    return ImageRecord(path, size, mtime)
+
+  def scan_one(path):
+    "Return the images (as list items) and subdirectories of a directory"
+    items, subdirs = [], []
+    with os.scandir(path) as entries:
+      for entry in entries:
+        # Check the name first: most entries are rejected without having to
+        # ask what type of file they are
+        if is_image(entry.name):
+          if not entry.is_dir():
+            item = make_item(entry.path, entry)
+            if item is not None:
+              items.append(item)
+            continue
+        if recursive and entry.is_dir() and not entry.is_symlink():
+          # Like os.walk, don't descend into symlinked directories
+          subdirs.append(entry.path)
+    return items, subdirs
+
+  def scan_tree(path):
+    """
+    Scan a directory tree, listing directories in parallel. The result is
+    in the same order as a serial depth-first scan.
+    """
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(SCAN_THREADS) as pool:
+      pending = {pool.submit(scan_one, path): path}
+      while pending:
+        done, _ = concurrent.futures.wait(pending,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          dirpath = pending.pop(future)
+          try:
+            results[dirpath] = future.result()
+          except OSError as err:
+            if dirpath == path:
+              raise
+            logger.error("Failed to scan %r: %s", dirpath, err)
+            continue
+          for subdir in results[dirpath][1]:
+            pending[pool.submit(scan_one, subdir)] = subdir
+
+    stack = [path]
+    while stack:
+      items, subdirs = results.get(stack.pop(), ((), ()))
+      yield from items
+      stack.extend(reversed(subdirs))
+
   def list_path(path):
     if os.path.isfile(path):
-      yield path
+      if is_image(path):
+        item = make_item(path)
+        if item is not None:
+          yield item
     elif os.path.isdir(path):
       if recursive:
-        for root, dirs, files in os.walk(path):
-          for file in files:
-            yield os.path.join(root, file)
+        yield from scan_tree(path)
       else:
-        for item in os.listdir(path):
-          yield os.path.join(path, item)
+        yield from scan_one(path)[0]
     elif cont_on_error:
       logger.error("Invalid object %r", path)
     else:
@@ -1315,46 +2052,122 @@ def get_images(*paths, recursive=False, quick=False, cont_on_error=False):
 
   images = []
   for name in paths:
-    for filepath in list_path(name):
-      if is_image(filepath):
-        images.append(filepath)
+    images.extend(list_path(name))
 
   # Filter out the images that can't be loaded
   if not quick:
-    filtered_images = []
-    for idx, image in enumerate(images):
-      try:
-        open_image(image)
-        filtered_images.append(image)
-      except (IOError, ValueError) as err:
-        logger.error("Failed to open image %d %r", idx, image)
-        logger.error("Original exception below:")
-        logger.exception(err)
-    images = filtered_images
+    image_paths = [image.path for image in images] if with_stat else images
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+      results = pool.map(_can_open, image_paths, chunksize=32)
+      images = [image for image, result in zip(images, results)
+          if result is not None]
   else:
-    logger.info("Skipping precheck of %d image(s)", len(images))
+    logger.debug("Skipping precheck of %d image(s)", len(images))
 
   return images
 
-def build_mark_write_function(path):
-  """Create a mark function to write an image to `path`"""
-  logger.debug("Building mark function for %r", path)
+def load_icon(path):
+  """Open and decode the icon, returning None if it can't be loaded"""
+  try:
+    icon = Image.open(path)
+    icon.load()
+  except OSError:
+    logger.info("Icon %s not found; not using an icon", path)
+    return None
+  return icon
 
-  def mark_func(image_path):
-    """Mark function: write image path to the path given"""
-    mode = "a+t" if os.path.isfile(path) else "wt"
-    logger.trace("open(%r, %r) to write %r", path, mode, image_path)
-    with open(path, mode) as fobj:
-      fobj.write(image_path)
-      fobj.write(os.linesep)
-      fobj.close()
+class TextWorker:
+  """
+  Text function that sends paths to a single, long-running program.
+
+  Each path is written to the program's stdin as a line. The program replies
+  with any number of lines on stdout, followed by a line containing exactly
+  TEXT_END. Replies are read on a background thread; a program that doesn't
+  finish its reply within TEXT_TIMEOUT seconds is stopped. The program is
+  (re)started as needed; its stderr goes directly to the terminal.
+  """
 
-  return mark_func
+  def __init__(self, prog, timeout=TEXT_TIMEOUT):
+    self._args = shlex.split(prog)
+    self._cmd = subprocess.list2cmdline(self._args)
+    self._timeout = timeout
+    self._proc = None
+    self._lines = None
+    self._reader = None
+
+  def _start(self):
+    """Start the program and a thread queueing its output lines"""
+    logger.debug("Starting text program %r", self._cmd)
+    self._proc = Popen(self._args, stdin=PIPE, stdout=PIPE)
+    self._lines = queue.Queue()
+    self._reader = threading.Thread(target=self._read_lines,
+        args=(self._proc.stdout, self._lines), daemon=True)
+    self._reader.start()
+
+  @staticmethod
+  def _read_lines(stream, lines):
+    """Queue each line of the stream; None marks the end of the output"""
+    try:
+      with stream:
+        for line in stream:
+          lines.put(line.decode().rstrip("\r\n"))
+    finally:
+      lines.put(None)
+
+  def close(self):
+    """Stop the program, if it's running"""
+    proc, self._proc = self._proc, None
+    if proc is None:
+      return
+    if proc.poll() is None:
+      proc.terminate()
+      try:
+        proc.wait(timeout=self._timeout)
+      except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    proc.stdin.close()
+    # The reader sees EOF now that the program has exited; it closes stdout
+    self._reader.join(timeout=self._timeout)
+
+  def __call__(self, path):
+    """Ask the running program for the text for the path"""
+    if self._proc is None or self._proc.poll() is not None:
+      self.close()
+      self._start()
+    lines = []
+    deadline = time.monotonic() + self._timeout
+    try:
+      self._proc.stdin.write(path.encode() + b"\n")
+      self._proc.stdin.flush()
+      while True:
+        line = self._lines.get(timeout=max(0, deadline - time.monotonic()))
+        if line is None:
+          logger.error("Program %r exited before finishing its output",
+              self._cmd)
+          break
+        if line == TEXT_END:
+          return "\n".join(lines)
+        lines.append(line)
+    except queue.Empty:
+      logger.error("Program %r didn't reply within %ss; stopping it",
+          self._cmd, self._timeout)
+    except OSError as err:
+      logger.error("Failed to communicate with %r: %s", self._cmd, err)
+    # The program's output can't be trusted to line up with ours anymore
+    self.close()
+    return "\n".join(lines)
+
+def build_text_worker_function(prog):
+  """Build a TextWorker for the program; see TextWorker"""
+  return TextWorker(prog)
 
 def build_text_function(program_string):
   """Build a text function from a given program string"""
   pipe = False
   prog = program_string
+  if prog.startswith("||"):
+    return build_text_worker_function(prog[2:])
   if prog.startswith("|"):
     pipe = True
     prog = prog[1:]
@@ -1382,20 +2195,14 @@ def build_text_function(program_string):
   return text_func
 
 def _parse_sort_arg(sort_arg, reverse):
-  """Parse a sort argument into a (mode, func, reverse?) triple"""
-  sort_mode = sort_arg
-  sort_func = lambda fname: fname
-  sort_rev = reverse
-  if sort_arg.startswith("r") and sort_arg[1:] in SORT_MODES:
-    sort_mode = sort_arg[1:]
-    sort_rev = True
-  if sort_mode == SORT_NAME:
-    sort_func = lambda fname: fname
-  elif sort_mode == SORT_TIME:
-    sort_func = lambda fname: os.stat(fname).st_mtime
-  elif sort_mode == SORT_SIZE:
-    sort_func = lambda fname: os.stat(fname).st_size
-  return sort_mode, sort_func, sort_rev
+  """
+  Parse a sort argument into a (mode, func, reverse?) triple. The function
+  is a sort key: None to sort paths by name, or a function taking an
+  ImageRecord for the modes that need file metadata.
+  """
+  sort_mode, sort_func, sort_rev = _SORT_TABLE.get(sort_arg,
+      (sort_arg, None, False))
+  return sort_mode, sort_func, sort_rev or reverse
 
 def _print_help(argparser, args):
   """Print help text"""
@@ -1430,6 +2237,11 @@ def _print_help(argparser, args):
   the output is displayed. Anything <PROG> writes to stderr is displayed
   directly to the terminal. Be careful with quoting!
 
+  If <PROG> starts with two pipes "||", then <PROG> is started only once and
+  must keep running: each <image-path> is written to it as a line, and it must
+  reply with the text to display followed by a line containing just "---END---".
+  This avoids starting a new process for every image.
+
   Per-line formatting is supported with simple syntax:
     [[formatting]]text
   where "formatting" is one or more of the following, separated by both a comma
@@ -1482,8 +2294,10 @@ def main():
       help="assume images given by -F are relative to the -F argument")
   ag.add_argument("-M", "--max", type=int, metavar="NUM",
       help="after sorting, keep only the first %(metavar)s images")
+  ag.add_argument("--precheck", action="store_true",
+      help="verify image files before starting (slow for large image sets)")
   ag.add_argument("--skip-precheck", action="store_true",
-      help="skip pre-verifying image files (useful for large image sets)")
+      help=argparse.SUPPRESS) # now the default; kept for compatibility
   ag.add_argument("-E", "--ignore-errors", action="store_true",
       help="continue even if some of the images are invalid")
 
@@ -1500,6 +2314,11 @@ def main():
       help="display image name and attributes over the image")
   ag.add_argument("--add-text-from", action="append", metavar="PROG",
       help="display text from program %(metavar)s (see --help-text-from)")
+  ag.add_argument("-C", "--cache", action="store_true",
+      help="cache scaled images on disk to speed up later sessions")
+  ag.add_argument("--cache-dir", metavar="PATH",
+      help="directory for cached images (implies -C; default: {})".format(
+        get_cache_dir()))
 
   ag = ap.add_argument_group("output control")
   ag.add_argument("-o", "--out", metavar="PATH",
@@ -1561,13 +2380,12 @@ def main():
   elif args.verbose:
     logger.setLevel(logging.DEBUG)
 
-  show_help = any((
-    args.help,
-    args.help_text_from,
-    args.help_write,
-    args.help_sort,
-    args.help_keys,
-    args.help_all))
+  show_help = (args.help
+      or args.help_text_from
+      or args.help_write
+      or args.help_sort
+      or args.help_keys
+      or args.help_all)
   if show_help:
     _print_help(ap, args)
     raise SystemExit(0)
@@ -1586,9 +2404,20 @@ def main():
     images_args.append(os.curdir)
   logger.debug("Input images: %d: %s", len(images_args), images_args)
 
-  # Get list of paths to images to examine
+  # Decode the icon while we scan for images. Only the PIL work can run in
+  # the background: Tk must be created and used on the main thread.
+  icon_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  icon_future = icon_pool.submit(load_icon,
+      get_asset_path("image-x-generic.png"))
+  icon_pool.shutdown(wait=False)
+
+  # Get list of paths to images to examine, along with their metadata if the
+  # sort needs it (scandir gives us that without an extra lookup)
+  sort_mode, sort_func, sort_rev = _parse_sort_arg(args.sort, args.reverse)
+  with_stat = not args.sort_via and sort_mode in (SORT_TIME, SORT_SIZE)
   images = get_images(*images_args, recursive=args.recurse,
-      quick=args.skip_precheck, cont_on_error=args.ignore_errors)
+      quick=not args.precheck, cont_on_error=args.ignore_errors,
+      with_stat=with_stat)
   if not images:
     logger.error("No images left to scan!")
     raise SystemExit(1)
@@ -1597,7 +2426,6 @@ def main():
   if args.sort_via:
     images = exec_program(args.sort_via, images)
   else:
-    sort_mode, sort_func, sort_rev = _parse_sort_arg(args.sort, args.reverse)
     if sort_mode == SORT_RAND:
       logger.debug("Shuffling images")
       seed = args.seed
@@ -1609,9 +2437,9 @@ def main():
       rand.shuffle(images)
     elif sort_mode != SORT_NONE:
       logger.debug("Sorting by %s (reverse=%s)", sort_mode, sort_rev)
-      images.sort(key=sort_func)
-      if sort_rev:
-        images = list(reversed(images))
+      images.sort(key=sort_func, reverse=sort_rev)
+  if with_stat:
+    images = [record.path for record in images]
 
   if args.max is not None:
     logger.debug("Keeping only %d of %d images", args.max, len(images))
@@ -1630,42 +2458,47 @@ def main():
   if args.height is not None and args.height > 0:
     iheight = args.height
 
-  icon = get_asset_path("image-x-generic.png")
-  if not os.path.exists(icon):
-    logger.info("Icon %s not found; not using an icon", icon)
-    icon = None
+  if args.cache or args.cache_dir:
+    cache_dir = args.cache_dir or get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    mkwargs["cache_dir"] = cache_dir
 
   manager = ImageManager(images,
       width=iwidth,
       height=iheight,
       show_text=args.add_text,
-      icon=icon,
+      icon=icon_future.result(),
       **mkwargs)
 
   # Register output file, if given
   if args.out is not None:
-    if os.path.isfile(args.out) and os.stat(args.out).st_size > 0:
-      if not args.append:
+    try:
+      out_stat = os.stat(args.out)
+    except OSError:
+      out_stat = None
+    truncate = False
+    if out_stat is not None and stat.S_ISREG(out_stat.st_mode):
+      if out_stat.st_size > 0 and not args.append:
         if not args.force_overwrite:
           logger.error("%r: file exists and -f missing", args.out)
           ap.error(f"Refusing to overwrite file {args.out!r}")
         else:
           logger.warning("%r: file exists; deleting", args.out)
-          os.truncate(args.out, 0)
-    manager.add_output_file(args.out, args.format)
+          truncate = True
+    manager.add_output_file(args.out, compile_line_format(args.format),
+        truncate=truncate)
 
   # Register functions to call when a mark key is pressed
   if args.write1:
-    manager.add_mark_function('1', build_mark_write_function(args.write1))
+    manager.add_mark_path('1', args.write1)
   if args.write2:
-    manager.add_mark_function('2', build_mark_write_function(args.write2))
+    manager.add_mark_path('2', args.write2)
   if args.bind:
     for bindkey, bindcmd in args.bind:
       manager.add_keybind(bindkey, bindcmd)
   if args.write_mark:
     for mark_nr, path in args.write_mark:
-      logger.debug("Writing images to %r on MARK-%s", path, mark_nr)
-      manager.add_key_function(mark_nr, build_mark_write_function(path))
+      manager.add_mark_path(mark_nr, path)
 
   # Register text function(s)
   if args.add_text_from is not None:
@@ -1678,20 +2511,14 @@ def main():
   # Don't run the main loop if we're interactive
   if not sys.flags.interactive:
     manager.root.mainloop()
-    path_actions = list(manager.actions().items())
+    rows = [(action[0], path, *action[1:])
+        for path, actions in manager.actions().items()
+        for action in actions]
     if args.text:
-      for path, actions in path_actions:
-        for action in actions:
-          print(" ".join((action[0], path, *action[1:])))
+      # Build the whole payload and emit it with one write
+      sys.stdout.write("".join(" ".join(row) + "\n" for row in rows))
     else:
-      writer = csv.writer(sys.stdout)
-      for path, actions in path_actions:
-        for action in actions:
-          row = []
-          row.append(action[0])
-          row.append(path)
-          row.extend(action[1:])
-          writer.writerow(row)
+      csv.writer(sys.stdout).writerows(rows)
   else:
     logger.info("Manager ready: manager.root.mainloop() to begin loop")
 
@@ -5,24 +5,120 @@ Encode a sequence of images to a video file.
 """
 
 import argparse
+import collections
+import concurrent.futures
 import logging
 import os
+import queue
 import sys
+import threading
 
 import cv2
+try:
+  from PIL import Image
+  HAVE_PIL = True
+except ImportError:
+  HAVE_PIL = False
 
 logging.basicConfig(format="%(module)s:%(lineno)s: %(levelname)s: %(message)s",
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PREFETCH_FRAMES = 8   # frames read ahead of the writer when not using a pool
+EXIF_ORIENTATION = 0x0112      # EXIF tag giving the image's orientation
+EXIF_TRANSPOSED = (5, 6, 7, 8) # orientations that swap width and height
+
 def deduce_frame_size(inputs, size):
   "Return a pair of (image_width, image_height) in pixels"
   if size and "," in size:
     wstr, hstr = size.split(",", 1)
     return int(wstr), int(hstr)
   logger.debug("Deducing size from %s", inputs[0])
+  if HAVE_PIL:
+    # Only reads the image header; the pixel data isn't decoded
+    try:
+      with Image.open(inputs[0]) as img:
+        width, height = img.size
+        # cv2.imread applies the EXIF orientation; match the frames it reads
+        if img.getexif().get(EXIF_ORIENTATION) in EXIF_TRANSPOSED:
+          width, height = height, width
+        return width, height
+    except OSError as err:
+      logger.debug("PIL can't read %s: %s; using OpenCV", inputs[0], err)
   img = cv2.imread(inputs[0])
-  return img.shape[0], img.shape[1]
+  return img.shape[1], img.shape[0]
+
+def _prefetch_frames(paths, depth=PREFETCH_FRAMES):
+  "Yield (path, frame) pairs, decoding up to depth frames ahead on a thread"
+  frames = queue.Queue(maxsize=depth)
+  done = threading.Event()
+
+  def reader():
+    "Decode the frames in order; None marks the end"
+    try:
+      for path in paths:
+        if done.is_set():
+          break
+        frames.put((path, cv2.imread(path)))
+    finally:
+      frames.put(None)
+
+  thread = threading.Thread(target=reader, daemon=True)
+  thread.start()
+  try:
+    while (item := frames.get()) is not None:
+      yield item
+  finally:
+    # Let the reader exit if we stopped early
+    done.set()
+    while thread.is_alive():
+      try:
+        frames.get(timeout=0.1)
+      except queue.Empty:
+        pass
+
+def read_frames(paths, jobs=1):
+  """
+  Yield the decoded frames for the paths, in order. With jobs > 1, frames
+  are decoded by a pool of worker processes, with at most 2*jobs frames
+  in flight at once. Otherwise, a single thread reads ahead of the caller.
+  """
+  if jobs <= 1:
+    yield from _prefetch_frames(paths)
+    return
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+    pending = collections.deque()
+    for path in paths:
+      pending.append((path, pool.submit(cv2.imread, path)))
+      if len(pending) >= 2*jobs:
+        path, future = pending.popleft()
+        yield path, future.result()
+    while pending:
+      path, future = pending.popleft()
+      yield path, future.result()
+
+def open_writer(path, fourcc, fps, frame_size, hwaccel=True):
+  """
+  Open a VideoWriter, asking the FFmpeg backend for hardware-accelerated
+  encoding if hwaccel is True. Falls back to the default (software) writer
+  if that fails or isn't supported by this build of OpenCV.
+  """
+  if hwaccel and hasattr(cv2, "VIDEOWRITER_PROP_HW_ACCELERATION"):
+    params = [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    try:
+      out = cv2.VideoWriter(path, cv2.CAP_FFMPEG, fourcc, fps, frame_size,
+          params)
+    except cv2.error as err:
+      logger.debug("Failed to open hardware-accelerated writer: %s", err)
+    else:
+      if out.isOpened():
+        accel = out.get(cv2.VIDEOWRITER_PROP_HW_ACCELERATION)
+        logger.debug("Opened writer with acceleration type %d", accel)
+        return out
+      out.release()
+    logger.debug("Falling back to software encoding")
+  return cv2.VideoWriter(path, fourcc, fps, frame_size)
 
 def main():
   ap = argparse.ArgumentParser()
@@ -37,6 +133,11 @@ def main():
       help="frames per second (default: %(default)s)")
   ap.add_argument("-s", "--size", metavar="W,H",
       help="image size in pixels; deduced if omitted")
+  ap.add_argument("--no-hwaccel", action="store_true",
+      help="don't try to use hardware-accelerated encoding")
+  ap.add_argument("-j", "--jobs", type=int, default=1,
+      help="number of processes decoding frames; with 1, a single thread"
+           " decodes ahead of the encoder (default: %(default)s)")
   ap.add_argument("-v", "--verbose", action="store_true",
       help="output diagnostic information")
   args = ap.parse_args()
@@ -57,11 +158,13 @@ def main():
 
   logger.info("Writing %d frames to %s at %d fps", len(paths), args.output, args.fps)
   fourcc = cv2.VideoWriter_fourcc(*args.format)
-  out = cv2.VideoWriter(args.output, fourcc, args.fps, frame_size)
+  out = open_writer(args.output, fourcc, args.fps, frame_size,
+      hwaccel=not args.no_hwaccel)
 
-  for path in paths:
-    img = cv2.imread(path)
-    logger.debug("Read %s: shape=%s", path, img.shape)
+  debug = logger.isEnabledFor(logging.DEBUG)
+  for path, img in read_frames(paths, args.jobs):
+    if debug:
+      logger.debug("Read %s: shape=%s", path, img.shape)
     out.write(img)
 
   out.release()
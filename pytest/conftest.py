@@ -40,12 +40,20 @@ def assets_config(pytestconfig, tmp_path_factory):
     "icons-local": os.path.join(assets_local, "icons")
   }
 
+def link_or_copy(src, dst):
+  "Hard link src to dst, copying instead if linking isn't possible"
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+  return dst
+
 @pytest.fixture(scope="session")
 def local_icons(pytestconfig, assets_config):
   ipath = assets_config["icons-path"]
   ilocal = assets_config["icons-local"]
-  debug_write(f"Copying {ipath} to {ilocal}...")
-  shutil.copytree(ipath, ilocal)
+  debug_write(f"Linking {ipath} to {ilocal}...")
+  shutil.copytree(ipath, ilocal, copy_function=link_or_copy)
   return ilocal
 
 # vim: set ts=2 sts=2 sw=2:
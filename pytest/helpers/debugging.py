@@ -4,6 +4,8 @@
 Functions to assist debugging within the pytest cases.
 """
 
+import collections
+import functools
 import inspect
 import logging
 import os
@@ -35,10 +37,16 @@ def inspect_object(obj, color=False, indent=0):
   "Performs a crude inspection of an object and returns a string"
   items = []
   istr = " "*indent
-  for k in dir(obj):
+  try:
+    # Instance attributes, without walking the MRO like dir() does
+    attrs = sorted(vars(obj).items())
+  except TypeError:
+    # No __dict__ (e.g. frames or objects using __slots__)
+    attrs = ((k, getattr(obj, k)) for k in dir(obj))
+  for k, v in attrs:
     if not k.startswith("_") and k not in ('f_builtins', 'f_globals'):
       key = k
-      val = repr(getattr(obj, k))
+      val = repr(v)
       if color:
         key = f"\x1b[1;34m{key}\x1b[0m"
         val = f"\x1b[3;33m{val}\x1b[0m"
@@ -53,9 +61,25 @@ def caller(adjust=1):
     f = f.f_back
   return f
 
+FInfo = collections.namedtuple("FInfo", ("filename", "function", "lineno"))
+
+def caller_info(adjust=1):
+  "Return an FInfo for the calling frame (adjusted by the given depth)"
+  # Cheaper than inspect.getframeinfo(), which also reads the source lines
+  f = sys._getframe(1)
+  while adjust > 0 and f.f_back is not None:
+    adjust -= 1
+    f = f.f_back
+  return FInfo(f.f_code.co_filename, f.f_code.co_name, f.f_lineno)
+
+@functools.lru_cache(maxsize=256)
+def _relpath(path):
+  "Cached os.path.relpath(); debug output comes from a handful of files"
+  return os.path.relpath(path)
+
 def _debug_write(finfo, fobj, msg, prefix):
   "Write frame info, prefix, and msg to fobj"
-  f_file = os.path.relpath(finfo.filename)
+  f_file = _relpath(finfo.filename)
   fobj.write(f"{f_file}:{finfo.function}:{finfo.lineno}: ")
   if len(prefix) > 0:
     fobj.write(prefix)
@@ -64,12 +88,12 @@ def _debug_write(finfo, fobj, msg, prefix):
 
 def debug_write(msg, prefix="DEBUG: "):
   "Output a debugging message"
-  c = inspect.getframeinfo(caller())
+  c = caller_info()
   _debug_write(c, sys.stdout, msg, prefix)
 
 def write_to_terminal(msg, prefix="INFO: "):
   "Output a message to the terminal, bypassing pytest entirely"
-  c = inspect.getframeinfo(caller())
+  c = caller_info()
   with term_file() as fobj:
     _debug_write(c, fobj, msg, prefix)
 
@@ -36,6 +36,19 @@ def test_util_format_size():
   assert imagemanage.format_size(1024**6) == "1024.0 PB"
   assert imagemanage.format_size(1024**6, places=0) == "1024 PB"
 
+def test_util_compile_line_format():
+  for lformat in ("{} {}\n", "{1}: {0}\n", "{{{}}} {}", "{:>5} {}", "x"):
+    format_line = imagemanage.compile_line_format(lformat)
+    assert format_line("path", "MARK-1") == lformat.format("path", "MARK-1")
+
+def test_util_fast_stat(tmp_path):
+  path = tmp_path / "file.bin"
+  path.write_bytes(b"x" * 100)
+  stat = os.stat(path)
+  assert imagemanage.fast_stat(str(path)) == (stat.st_size, stat.st_mtime)
+  with pytest.raises(OSError):
+    imagemanage.fast_stat(str(tmp_path / "missing"))
+
 def test_util_iterate_from():
   iterate_from = lambda l, i: list(imagemanage.iterate_from(l, i))
   l = list(range(10))
@@ -43,10 +56,81 @@ def test_util_iterate_from():
   assert iterate_from(l, 1) == l[1:] + l[:1]
   assert iterate_from(l, len(l)) == l
 
+def test_util_build_text_worker():
+  script = "while read l; do echo \"name: $l\"; echo ---END---; done"
+  func = imagemanage.build_text_function(f"||sh -c '{script}'")
+  assert func("a.png") == "name: a.png"
+  assert func("b.png") == "name: b.png"
+  func.close()
+
+def test_util_text_worker_timeout():
+  # Never prints TEXT_END; the worker must give up rather than block
+  script = "while read l; do echo \"name: $l\"; done"
+  worker = imagemanage.TextWorker(f"sh -c '{script}'", timeout=0.5)
+  assert worker("a.png") == "name: a.png"
+  worker.close()
+
+def test_load_scaled(tmp_path):
+  from PIL import Image
+  path = str(tmp_path / "image.png")
+  Image.new("RGB", (300, 200)).save(path)
+  load = lambda mode: imagemanage.load_scaled(path, 0, (100, 100), mode)
+  image, real_size, frame_count = load(imagemanage.SCALE_SHRINK)
+  assert real_size == (300, 200)
+  assert frame_count == 1
+  assert image.size == (100, 67)
+  # Cache hits return an equal copy, never the shared cached object
+  hits = imagemanage._load_scaled.cache_info().hits
+  again = load(imagemanage.SCALE_SHRINK)[0]
+  assert imagemanage._load_scaled.cache_info().hits == hits + 1
+  assert again is not image and again.tobytes() == image.tobytes()
+  assert load(imagemanage.SCALE_NONE)[0].size == (300, 200)
+
+def test_load_scaled_animated(tmp_path):
+  from PIL import Image
+  path = str(tmp_path / "anim.gif")
+  frames = [Image.new("L", (300, 200), shade) for shade in (0, 128, 255)]
+  frames[0].save(path, save_all=True, append_images=frames[1:])
+  # Step through the frames the way the viewer does during playback
+  shades = []
+  frame_index, frame_count = 0, None
+  while frame_count is None or frame_index < frame_count:
+    image, _, frame_count = imagemanage.load_scaled(path, frame_index,
+        (100, 100), imagemanage.SCALE_SHRINK)
+    assert image.size == (100, 67)
+    shades.append(image.convert("L").getpixel((0, 0)))
+    frame_index += 1
+  assert frame_count == 3
+  assert shades == [0, 128, 255]
+  cached = imagemanage._load_scaled(path, 1, (100, 100),
+      imagemanage.SCALE_SHRINK, 0, imagemanage.DEFAULT_SAMPLE_METHOD, None)[0]
+  # The cached frame must not keep the GIF open
+  assert getattr(cached, "fp", None) is None
+
+def test_load_scaled_cache_dir(tmp_path):
+  from PIL import Image
+  path = str(tmp_path / "image.png")
+  cache_dir = tmp_path / "cache"
+  cache_dir.mkdir()
+  Image.new("RGB", (300, 200)).save(path)
+  image = imagemanage.load_scaled(path, 0, (100, 100),
+      imagemanage.SCALE_SHRINK, cache_dir=str(cache_dir))[0]
+  thumbs = list(cache_dir.iterdir())
+  assert len(thumbs) == 1
+  assert Image.open(thumbs[0]).tobytes() == image.tobytes()
+  # A different sampler must not be served the cached thumbnail
+  imagemanage.load_scaled(path, 0, (100, 100), imagemanage.SCALE_SHRINK,
+      sample_method=Image.NEAREST, cache_dir=str(cache_dir))
+  assert len(list(cache_dir.iterdir())) == 2
+
 def test_get_images(local_icons):
   images_none = imagemanage.get_images(local_icons)
   assert len(images_none) == 0
   images_all = imagemanage.get_images(local_icons, recursive=True)
   assert len(images_all) > 0
+  images_stat = imagemanage.get_images(local_icons, recursive=True,
+      with_stat=True)
+  assert [record.path for record in images_stat] == images_all
+  assert all(record.size > 0 for record in images_stat)
 
 # vim: set ts=2 sts=2 sw=2:
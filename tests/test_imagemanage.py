@@ -4,6 +4,7 @@
 Test imagemanage.py
 """
 
+import concurrent.futures
 import os
 import shutil
 import sys
@@ -15,14 +16,33 @@ TEST_PATH = os.path.dirname(sys.argv[0])
 sys.path.append(os.path.join(TEST_PATH, os.path.pardir))
 import imagemanage
 
-def _build_dataset(test_path, n=8, size=(32, 32)):
-  "Create images for testing"
-  for nr in range(n):
-    name = "image-{}x{}-{:02d}.png".format(size[0], size[1], nr)
-    image = Image.new("RGB", size, color="black")
-    draw = ImageDraw.ImageDraw(image)
-    draw.text((0, 0), name)
-    image.save(os.path.join(test_path, name))
+# Datasets smaller than this aren't worth starting worker processes for
+PARALLEL_MIN_IMAGES = 64
+
+def _make_one(task):
+  "Create a single test image; task is (test_path, size, nr)"
+  test_path, size, nr = task
+  name = "image-{}x{}-{:02d}.png".format(size[0], size[1], nr)
+  image = Image.new("RGB", size, color="black")
+  draw = ImageDraw.ImageDraw(image)
+  draw.text((0, 0), name)
+  image.save(os.path.join(test_path, name))
+
+def _build_dataset(test_path, n=8, size=(32, 32), parallel=None):
+  """
+  Create images for testing. The images are created by a pool of processes
+  if parallel is True, or if it's None and there are enough of them.
+  """
+  tasks = [(test_path, size, nr) for nr in range(n)]
+  if parallel is None:
+    parallel = n >= PARALLEL_MIN_IMAGES
+  if not parallel:
+    for task in tasks:
+      _make_one(task)
+  else:
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+      for _ in pool.map(_make_one, tasks, chunksize=16):
+        pass
 
 class TestImages(unittest.TestCase):
   def __init__(self, *args, **kwargs):
@@ -47,6 +67,17 @@ class TestImages(unittest.TestCase):
     images_all = imagemanage.get_images(self._path, recursive=True)
     self.assertTrue(images_all)
 
+  def test_build_dataset_parallel(self):
+    path = os.path.join(self._path, "parallel")
+    os.makedirs(path)
+    _build_dataset(path, 4, self._isize, parallel=True)
+    names = ["image-{}x{}-{:02d}.png".format(*self._isize, nr)
+        for nr in range(4)]
+    self.assertEqual(sorted(os.listdir(path)), names)
+    for name in os.listdir(path):
+      with Image.open(os.path.join(path, name)) as image:
+        self.assertEqual(image.size, self._isize)
+
   # TODO: test the actual class
 
 class TestUtilityFunctions(unittest.TestCase):
@@ -80,6 +111,9 @@ class TestUtilityFunctions(unittest.TestCase):
     self.assertTrue(imagemanage.is_image("foo.jpg"))
     self.assertTrue(imagemanage.is_image("foo.jpeg"))
     self.assertTrue(imagemanage.is_image("foo.gif"))
+    self.assertTrue(imagemanage.is_image("foo.svg.gz"))
+    self.assertTrue(imagemanage.is_image("FOO.SVG.GZ"))
+    self.assertFalse(imagemanage.is_image("foo.gz"))
     self.assertFalse(imagemanage.is_image("foo"))
     self.assertFalse(imagemanage.is_image("foo.mpg"))
 
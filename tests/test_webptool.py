@@ -10,6 +10,7 @@ import os
 import shutil
 import sys
 import unittest
+from unittest import mock
 from PIL import Image, ImageDraw
 
 TEST_PATH = os.path.dirname(sys.argv[0])
@@ -64,6 +65,49 @@ class TestSimple(unittest.TestCase):
     self.assertTrue(webptool.is_format_string("Test {:2d}"))
     self.assertFalse(webptool.is_format_string("Test {{:2d}}"))
 
+  def test_gather_inputs(self):
+    paths = [self._path(self._name_format.format(i)) for i in range(3)]
+    broken = self._path("broken.png")
+    os.symlink(self._path("missing.png"), broken)
+    self.assertEqual(webptool.gather_inputs(paths + [broken], None), paths)
+    self.assertEqual(webptool.gather_inputs([broken], None), [])
+
+  def test_gather_inputs_case(self):
+    # Simulate a case-insensitive filesystem: the name differs in case from
+    # the file on disk, so only os.path.exists can find it
+    paths = [self._path(self._name_format.format(i)) for i in range(3)]
+    other = self._path(self._name_format.format(3).upper())
+    exists = os.path.exists
+    def exists_nocase(path):
+      head, tail = os.path.split(path)
+      return exists(os.path.join(head, tail.lower()))
+    with mock.patch("os.path.exists", exists_nocase):
+      result = webptool.gather_inputs(paths + [other], None)
+    self.assertEqual(result, paths + [other])
+
+  def test_parse_webpmux_output(self):
+    out = "\n".join((
+      "Canvas size: 400 x 300",
+      "Features present: animation transparency",
+      "Background color : 0xFF000000  Loop Count : 0",
+      "Number of frames: 1",
+      "No.: width height alpha x_offset y_offset duration   dispose blend"
+        " image_size  compression",
+      "  1:   400   300   yes        0        0       70       none    no"
+        "       5178    lossless",
+      "No features present.",
+      ""))
+    self.assertEqual(list(webptool.parse_webpmux_output(out)), [
+      ("Canvas size", "400 x 300"),
+      ("Features present", "animation transparency"),
+      ("Background color", "0xFF000000"),
+      ("Loop Count", "0"),
+      ("Number of frames", "1"),
+      ("No.", "width height alpha x_offset y_offset duration   dispose"
+        " blend image_size  compression"),
+      ("1", "400   300   yes        0        0       70       none    no"
+        "       5178    lossless")])
+
   def test_deduce_mode(self):
     def test(pin, pout, mode):
       inputs = pin
@@ -79,6 +123,10 @@ class TestSimple(unittest.TestCase):
     test(["t.webp", "v.webp"], "", MODE_E)
     test(["t1.png", "t2.png"], "o.webp", MODE_C)
     test(["t1.webp", "t2.png"], "o.webp", MODE_C)
+    test("T.WEBP", "", MODE_E)
+    test("t.webp", None, MODE_E)
+    test("t.png", None, None)
+    test(["t1.png", "t2.png"], "O.WebP", MODE_C)
 
   def test_is_ready(self):
     self.assertTrue(os.path.isdir(self._test_path))
@@ -94,6 +142,15 @@ class TestSimple(unittest.TestCase):
     webptool.create_webp_file(images, opath)
     self.assertTrue(os.path.exists(opath))
 
+  def test_read_webp_info(self):
+    in_path = self._path("1.webp")
+    self.test_create_simple()
+    vinfo = webptool.read_webp_info(in_path)
+    self.assertEqual(vinfo["size"], self._image_size)
+    self.assertEqual(vinfo["nframes"], self._image_count)
+    self.assertEqual(len(vinfo["frames"]), self._image_count)
+    self.assertIn("animation", vinfo["features"])
+
   def test_extract_simple(self):
     in_path = self._path("1.webp")
     self.test_create_simple()
@@ -5,16 +5,23 @@ Create or split WebP images
 """
 
 import argparse
+import collections
+import concurrent.futures
+import functools
+import itertools
 import json
 import logging
 import os
+import re
+import shutil
 import string
+import struct
 import subprocess
 import sys
 
-import webp
 from PIL import Image
-import cv2
+# cv2, numpy, and webp take most of the startup time, so they're imported
+# by the functions that use them; --help and describe need none of them
 
 logging.basicConfig(level=logging.INFO,
     format="%(module)s:%(lineno)s: %(levelname)s: %(message)s")
@@ -26,14 +33,45 @@ MODE_EXTRACT = "extract-webp"
 MODE_ENCODE = "encode-video"
 DEFAULT_WEBP_NAME = "image.webp"
 DEFAULT_NAME_FORMAT = "image-{:04d}.png"
+DEFAULT_ENCODER = "MP4V"
+DEFAULT_WEBP_FPS = 30.0 # matches webp.save_images()
+ENCODER_NVENC = "nvenc" # ffmpeg's h264_nvenc rather than a FourCC
 
+# One "key: value" field of webpmux -info output; a line may hold several
+# fields separated by two or more spaces. Lines without a colon match junk.
+_WEBPMUX_FIELD = re.compile(r"""
+  (?P<key>[^:\n]+?)[ \t]*:[ \t]*(?P<val>[^\n]*?)[ \t]*
+    (?=[ \t]{2,}[^:\n]+:|$)
+  | ^(?P<junk>[^:\n]+)$
+""", re.M | re.X)
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 2) # threads for parallel I/O
+PREFETCH_FRAMES = 8 # frames decoded ahead of the video encoder
+
+class FormatAllowMissing(string.Formatter):
+  "Formatter that substitutes the key itself for missing arguments"
+  def get_value(self, key, args, kwargs):
+    if isinstance(key, int):
+      if key < len(args):
+        return args[key]
+    elif key in kwargs:
+      return kwargs[key]
+    return key
+
+_FORMATTER = FormatAllowMissing()
+
+@functools.lru_cache(maxsize=128)
 def is_format_string(value):
   "Return True if the string contains str.format() sequences"
-  fields = list(string.Formatter().parse(value))
-  for (literal, name, spec, conv) in string.Formatter().parse(value):
-    if not (name is None and spec is None and conv is None):
-      return True
-  return False
+  return any(not (name is None and spec is None and conv is None)
+             for (_, name, spec, conv) in _FORMATTER.parse(value))
+
+def is_webp_path(path):
+  "Return True if the path has a .webp extension (in any case)"
+  return os.path.splitext(path)[1].lower() == ".webp"
+
+def webp_mask(paths):
+  "Return a list of is_webp_path() results, one per path"
+  return [is_webp_path(path) for path in paths]
 
 def gather_inputs(path_arg, input_arg):
   "Interpret the two arguments into a list of paths"
@@ -46,9 +84,31 @@ def gather_inputs(path_arg, input_arg):
         for line in fobj:
           yield line.rstrip()
 
+  paths = list(iter_inputs())
+  dir_counts = collections.Counter(os.path.dirname(path) for path in paths)
+  listings = {}
+
+  def path_exists(path):
+    "Check for path, listing its directory once if it's shared"
+    head, tail = os.path.split(path)
+    if dir_counts[head] < 2 or tail in ("", ".", ".."):
+      return os.path.exists(path)
+    if head not in listings:
+      try:
+        with os.scandir(head or ".") as entries:
+          listings[head] = {ent.name: ent.is_symlink() for ent in entries}
+      except OSError:
+        listings[head] = None
+    # Names missing from the listing may still exist on case-insensitive
+    # filesystems, and symlinks are followed so that broken links are
+    # rejected; only plain listed entries skip the stat
+    if listings[head] is None or listings[head].get(tail, True):
+      return os.path.exists(path)
+    return True
+
   results = []
-  for path in iter_inputs():
-    if os.path.exists(path):
+  for path in paths:
+    if path_exists(path):
       results.append(path)
     else:
       logger.warning("Ignoring %r: path doesn't exist", path)
@@ -59,23 +119,136 @@ def webpmux_info(path):
   args = ["webpmux", "-info", path]
   logger.debug("Invoking %s", subprocess.list2cmdline(args))
   out = subprocess.check_output(args).decode()
-  for lnr, line in enumerate(out.splitlines()):
-    logger.debug("webpmux %s line %d: %s", path, lnr, line)
-    if ":" not in line:
-      if line != "No features present.":
-        logger.warning("Can't parse line %r", line)
-    elif line.count(":") == 1:
-      lkey, lval = line.split(":")
-      yield lkey.strip(), lval.strip()
-    elif line.count(":") == 2:
-      for field in line.split("  "):
-        lkey, lval = field.split(":", 1)
-        yield lkey.strip(), lval.strip()
-    else:
-      logger.warning("Unable to parse line %r", line)
+  logger.debug("webpmux %s output: %r", path, out)
+  return parse_webpmux_output(out)
+
+def parse_webpmux_output(out):
+  "Yield the (key, value) pairs from webpmux -info output"
+  for match in _WEBPMUX_FIELD.finditer(out):
+    junk = match.group("junk")
+    if junk is None:
+      yield match.group("key").strip(), match.group("val")
+    elif junk.strip() != "No features present.":
+      logger.warning("Can't parse line %r", junk)
+
+def _read_chunks(fobj, end):
+  "Yield (fourcc, offset, size) for each RIFF chunk up to the end offset"
+  while fobj.tell() + 8 <= end:
+    header = fobj.read(8)
+    fourcc = header[:4].decode("latin-1")
+    size = struct.unpack("<I", header[4:])[0]
+    offset = fobj.tell()
+    yield fourcc, offset, size
+    fobj.seek(offset + size + (size & 1)) # chunks are padded to even sizes
+
+def _frame_info(fobj, end):
+  """
+  Inspect the chunks of a single image (ALPH, VP8, VP8L) and return a
+  partial frame entry with its alpha, image_size, and compression fields
+  """
+  alpha, compression, image_size = False, None, 0
+  for fourcc, offset, size in _read_chunks(fobj, end):
+    image_size += 8 + size + (size & 1)
+    if fourcc == "ALPH":
+      alpha = True
+    elif fourcc == "VP8 ":
+      compression = "lossy"
+    elif fourcc == "VP8L":
+      compression = "lossless"
+      fobj.seek(offset + 1) # skip the signature byte
+      # The alpha_is_used bit follows the 14-bit width and height fields
+      if struct.unpack("<I", fobj.read(4))[0] & (1 << 28):
+        alpha = True
+      fobj.seek(offset + size + (size & 1))
+  return {
+    "alpha": "yes" if alpha else "no",
+    "image_size": image_size,
+    "compression": compression
+  }
+
+def read_webp_info(path):
+  """
+  Get information about the WebP file by reading its RIFF chunks directly.
+  Returns the same structure as get_webp_info(); only headers are read, no
+  image data is decoded.
+  """
+  results = {
+    "size": (0, 0),
+    "features": [],
+    "bgcolor": 0,
+    "loops": 0,
+    "nframes": 0,
+    "frames": [],
+    "duration": None
+  }
+  with open(path, "rb") as fobj:
+    header = fobj.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WEBP":
+      raise ValueError(f"{path}: not a WebP file")
+    end = min(8 + struct.unpack("<I", header[4:8])[0],
+        os.fstat(fobj.fileno()).st_size)
+    for fourcc, offset, size in _read_chunks(fobj, end):
+      if fourcc == "VP8X":
+        data = fobj.read(10)
+        flags = data[0]
+        # Names and order as reported by webpmux -info
+        for bit, name in ((0x02, "animation"), (0x20, "ICC profile"),
+            (0x08, "EXIF metadata"), (0x04, "XMP metadata"),
+            (0x10, "transparency")):
+          if flags & bit:
+            results["features"].extend(name.split())
+        width = 1 + int.from_bytes(data[4:7], "little")
+        height = 1 + int.from_bytes(data[7:10], "little")
+        results["size"] = (width, height)
+      elif fourcc == "ANIM":
+        bgcolor, loops = struct.unpack("<IH", fobj.read(6))
+        results["bgcolor"] = bgcolor
+        results["loops"] = loops
+      elif fourcc == "ANMF":
+        data = fobj.read(16)
+        fields = [int.from_bytes(data[idx:idx+3], "little")
+            for idx in range(0, 15, 3)]
+        image_info = _frame_info(fobj, offset + size)
+        # Same keys, in the same order, as the webpmux -info frame table
+        finfo = {
+          "num": len(results["frames"]) + 1,
+          "width": fields[2] + 1,
+          "height": fields[3] + 1,
+          "alpha": image_info["alpha"],
+          "x_offset": fields[0] * 2,
+          "y_offset": fields[1] * 2,
+          "duration": fields[4],
+          "dispose": "background" if data[15] & 0x01 else "none",
+          "blend": "no" if data[15] & 0x02 else "yes",
+          "image_size": image_info["image_size"],
+          "compression": image_info["compression"]
+        }
+        if results["duration"] is None:
+          results["duration"] = 0
+        results["duration"] += finfo["duration"]
+        results["frames"].append(finfo)
+      elif fourcc == "XMP ":
+        results["xmpsize"] = str(size)
+      elif fourcc in ("VP8 ", "VP8L") and results["size"] == (0, 0):
+        # Simple (non-extended) file: take the size from the bitstream
+        data = fobj.read(10)
+        if fourcc == "VP8L":
+          bits = struct.unpack("<I", data[1:5])[0]
+          results["size"] = (1 + (bits & 0x3fff),
+              1 + ((bits >> 14) & 0x3fff))
+        else:
+          width, height = struct.unpack("<HH", data[6:10])
+          results["size"] = (width & 0x3fff, height & 0x3fff)
+  results["nframes"] = len(results["frames"])
+  return results
 
-def get_webp_info(path):
-  "Get information about the WebP file"
+def get_webp_info(path, use_webpmux=False):
+  """
+  Get information about the WebP file. The file is parsed directly unless
+  use_webpmux is True, in which case the output of webpmux -info is used.
+  """
+  if not use_webpmux:
+    return read_webp_info(path)
   webpinfo = webpmux_info(path)
   results = {
     "size": (0, 0),
@@ -132,28 +305,53 @@ def get_webp_info(path):
         results["nframes"], len(results["frames"]))
   return results
 
-def load_images(paths):
-  "Create a list of PIL images, handling WebP files as multiple images"
-  results = []
-  for path in paths:
-    if path.endswith(".webp"):
-      results.extend(webp.load_images(path))
-    else:
-      results.append(Image.open(path))
-  return results
+def _iter_webp_frames(path):
+  "Decode a WebP file one frame at a time, yielding RGBA PIL images"
+  import webp # pylint: disable=import-outside-toplevel
+  with open(path, "rb") as fobj:
+    data = webp.WebPData.from_buffer(fobj.read())
+  options = webp.WebPAnimDecoderOptions.new(
+      use_threads=True, color_mode=webp.WebPColorMode.RGBA)
+  decoder = webp.WebPAnimDecoder.new(data, options)
+  for arr, _ in decoder.frames():
+    yield Image.fromarray(arr, "RGBA")
+
+def iter_images(paths, mask=None):
+  """
+  Yield PIL images one at a time, handling WebP files as multiple images.
+  At most MAX_WORKERS files are opened ahead of the consumer.
+  """
+  if mask is None:
+    mask = webp_mask(paths)
+  pending = collections.deque()
+  # Opening files releases the GIL, so open a window of them in parallel
+  with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as pool:
+    for path, is_webp in zip(paths, mask):
+      if is_webp:
+        while pending:
+          yield pending.popleft().result()
+        yield from _iter_webp_frames(path)
+        continue
+      pending.append(pool.submit(Image.open, path))
+      if len(pending) > MAX_WORKERS:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
 
-def image_size(image):
-  "Get the width and height of the image in pixels"
-  isize = image.getbbox()
-  return isize[2], isize[3]
+def load_images(paths, mask=None):
+  "Create a list of PIL images, handling WebP files as multiple images"
+  return list(iter_images(paths, mask))
 
-def deduce_mode(paths_in, path_out):
+def deduce_mode(paths_in, path_out, mask=None):
   "Determine what we're doing: creating or extracting WebP image(s)"
-  if path_out.endswith(".webp"):
+  if path_out is not None and is_webp_path(path_out):
     return MODE_CREATE
-  if any(path.endswith(".webp") for path in paths_in):
-    return MODE_EXTRACT
-  if is_format_string(path_out):
+  # Use the precomputed mask if given; otherwise stop at the first match
+  if mask is not None:
+    has_webp = any(mask)
+  else:
+    has_webp = any(map(is_webp_path, paths_in))
+  if has_webp or (path_out is not None and is_format_string(path_out)):
     return MODE_EXTRACT
   # Failed to deduce mode
   return None
@@ -167,7 +365,7 @@ def deduce_create_output(path_out):
     outpath = os.path.join(path_out, DEFAULT_WEBP_NAME)
     logger.warning("Output path is a directory; using %s", outpath)
     return outpath
-  if not path_out.endswith(".webp"):
+  if not is_webp_path(path_out):
     logger.warning("Output path does not end in .webp; continuing anyway")
   return path_out
 
@@ -186,108 +384,285 @@ def deduce_extract_output(path_out):
 
 def format_extract_filename(format_out, frame_number, **kwds):
   "Format a final output file path using the given the format arguments"
-  class FormatAllowMissing(string.Formatter):
-    def get_value(self ,key, args, kwargs):
-      if isinstance(key, int):
-        if key < len(args):
-          return args[key]
-      elif key in kwargs:
-        return kwargs[key]
-      return key
-  return FormatAllowMissing().format(format_out, frame_number, **kwds)
-
-def write_video(images, output_path, size_wxh=None, fps=24, encoder='MP4V'):
-  "Create a video file (default MP4 video) from the given image paths"
+  return _FORMATTER.format(format_out, frame_number, **kwds)
+
+def _read_bytes(path):
+  "Read a whole file, returning None if it can't be read"
+  try:
+    with open(path, "rb") as fobj:
+      return fobj.read()
+  except OSError as err:
+    logger.warning("Failed to read %s: %s", path, err)
+    return None
+
+def _decode_frame(data):
+  "Decode an encoded image into a BGR array, or None on failure"
+  # pylint: disable=import-outside-toplevel
+  import cv2
+  import numpy as np
+  if not data:
+    return None
+  return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+def _load_frame(path):
+  "Read and decode one frame; None if it can't be read or decoded"
+  return _decode_frame(_read_bytes(path))
+
+def _prefetch_frames(paths, depth=PREFETCH_FRAMES):
+  """
+  Yield decoded frames in order, with up to depth frames being read and
+  decoded on the thread pool ahead of the caller
+  """
+  pending = collections.deque()
+  # Reading and imdecode() both release the GIL, so frames load in parallel
+  # with each other and with the caller's encoding
+  with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as pool:
+    for path in paths:
+      pending.append(pool.submit(_load_frame, path))
+      if len(pending) > depth:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+@functools.lru_cache(maxsize=1)
+def have_nvenc():
+  "Return True if ffmpeg exists and can actually encode with h264_nvenc"
+  ffmpeg = shutil.which("ffmpeg")
+  if ffmpeg is None:
+    return False
+  # -encoders lists h264_nvenc whenever it's compiled in, so probe with a
+  # tiny encode to make sure a usable GPU and driver are present
+  cmd = [ffmpeg, "-hide_banner", "-loglevel", "error",
+      "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+      "-c:v", "h264_nvenc", "-f", "null", "-"]
+  try:
+    proc = subprocess.run(cmd, stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+  except OSError as err:
+    logger.debug("Failed to run %s: %s", ffmpeg, err)
+    return False
+  return proc.returncode == 0
+
+def write_video_nvenc(frames, output_path, size_wxh, fps=24):
+  "Encode the given BGR frames with ffmpeg's NVENC H.264 encoder"
+  # pylint: disable=import-outside-toplevel
+  import cv2
+  import numpy as np
+  width, height = size_wxh
+  cmd = [shutil.which("ffmpeg"), "-hide_banner", "-loglevel", "error", "-y",
+      "-f", "rawvideo", "-pix_fmt", "bgr24",
+      "-s", "{}x{}".format(width, height), "-r", str(fps), "-i", "-",
+      "-c:v", "h264_nvenc", "-pix_fmt", "yuv420p", output_path]
+  logger.debug("Running %s", " ".join(cmd))
+  proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+  resized = np.empty((height, width, 3), np.uint8)
+  try:
+    for fnum, img in enumerate(frames):
+      if img is None:
+        logger.warning("Skipping frame %d: failed to read image", fnum)
+        continue
+      # Raw frames must all match the size given to ffmpeg
+      if img.shape[:2] != (height, width):
+        img = cv2.resize(img, (width, height), dst=resized)
+      # Write the array's own buffer rather than a tobytes() copy
+      proc.stdin.write(np.ascontiguousarray(img))
+  finally:
+    proc.stdin.close()
+    status = proc.wait()
+  if status != 0:
+    raise RuntimeError("ffmpeg exited with status {}".format(status))
+
+def _write_frames(frames, output_path, size_wxh, fps, encoder):
+  "Encode BGR frames using the requested encoder"
+  import cv2 # pylint: disable=import-outside-toplevel
+  if encoder == ENCODER_NVENC:
+    if have_nvenc():
+      write_video_nvenc(frames, output_path, size_wxh, fps=fps)
+      return
+    logger.warning("NVENC is not available; falling back to %s",
+        DEFAULT_ENCODER)
+    encoder = DEFAULT_ENCODER
   fourcc = cv2.VideoWriter_fourcc(*encoder)
+  out = cv2.VideoWriter(output_path, fourcc, fps, size_wxh)
+  try:
+    for img in frames:
+      out.write(img)
+  finally:
+    out.release()
+
+def write_video(images, output_path, size_wxh=None, fps=24,
+                encoder=DEFAULT_ENCODER):
+  "Create a video file (default MP4 video) from the given image paths"
   logger.debug("Saving %d images to %s...", len(images), output_path)
   if size_wxh is None:
     logger.debug("Size not given; deducing from %s", images[0])
-    bounds = Image.open(images[0]).getbbox()
-    size_wxh = bounds[2], bounds[3]
-  out = cv2.VideoWriter(output_path, fourcc, fps, size_wxh)
+    with Image.open(images[0]) as image:
+      size_wxh = image.size
+  # Decode on a reader thread so the encoder isn't idle between frames
+  _write_frames(_prefetch_frames(images), output_path, size_wxh, fps, encoder)
+
+def _iter_bgr_frames(images):
+  """
+  Yield each PIL image as a contiguous BGR array. The same buffer is reused
+  for every frame of a given size, so each frame must be consumed (written)
+  before the next one is requested.
+  """
+  # pylint: disable=import-outside-toplevel
+  import cv2
+  import numpy as np
+  pil_to_bgr = {"RGB": cv2.COLOR_RGB2BGR, "RGBA": cv2.COLOR_RGBA2BGR}
+  buf = None
   for image in images:
-    img = cv2.imread(image)
-    out.write(img)
-  out.release()
+    code = pil_to_bgr.get(image.mode)
+    if code is None:
+      image = image.convert("RGB")
+      code = pil_to_bgr["RGB"]
+    src = np.asarray(image)
+    if buf is None or buf.shape[:2] != src.shape[:2]:
+      buf = np.empty(src.shape[:2] + (3,), np.uint8)
+    yield cv2.cvtColor(src, code, dst=buf)
 
-def describe_webp_file(path, *args, **kwargs):
-  "Display information about a single WebP file"
-  vinfo = get_webp_info(path)
-  images = load_images([path])
-  if not images:
-    raise ValueError(f"failed to load images from {path}")
-
-  # Determine real image size, ensure vinfo["size"] has it
-  isizes = tuple(set(image_size(image) for image in images))
-  isize = vinfo["size"]
-  if not isizes:
-    logger.warning("Could not get size of %s", path)
-  elif len(isizes) > 1:
-    logger.warning("%s has multiple sizes %r", path, isizes)
-    iwidth = max(isize[0] for isize in isizes)
-    iheight = max(isize[1] for isize in isizes)
-    isize = (iwidth, iheight)
-    logger.warning("%s: using size %s", path, isize)
-  else:
-    isize = isizes[0]
+def write_video_from_pil(images, output_path, size_wxh=None, fps=24,
+                         encoder=DEFAULT_ENCODER):
+  "Create a video file from an iterable of already-decoded PIL images"
+  images = iter(images)
+  first = next(images, None)
+  if first is None:
+    raise ValueError("no images to save to {}".format(output_path))
+  logger.debug("Saving frames to %s...", output_path)
+  if size_wxh is None:
+    size_wxh = first.size
+  frames = _iter_bgr_frames(itertools.chain((first,), images))
+  _write_frames(frames, output_path, size_wxh, fps, encoder)
+
+def webp_info_complete(vinfo):
+  "True if the webpmux info gives a usable size and frame count by itself"
+  if vinfo["size"][0] <= 0 or vinfo["size"][1] <= 0:
+    return False
+  if vinfo["nframes"] <= 0 or vinfo["nframes"] != len(vinfo["frames"]):
+    return False
+  return True
+
+def reconcile_webp_info(path, vinfo):
+  "Read the WebP headers and fix up vinfo's size and frame count to match"
+  # Pillow parses the container when opening but decodes no pixels
+  try:
+    with Image.open(path) as image:
+      isize = image.size
+      nframes = getattr(image, "n_frames", 1)
+  except OSError as err:
+    raise ValueError(f"failed to load images from {path}") from err
+
+  # Ensure vinfo["size"] has the real image size
   if isize != vinfo["size"]:
-    logger.warning("%s: inconsistent image size info=%r split=%r",
+    logger.warning("%s: inconsistent image size info=%r header=%r",
         path, vinfo["size"], isize)
     vinfo["size"] = (isize[0], isize[1])
 
   # Determine real frame count; ensure vinfo["nframes"] has it
-  nframes = len(images)
   if nframes != vinfo["nframes"]:
-    logger.warning("%s inconsistent frame count info=%d split=%d",
+    logger.warning("%s inconsistent frame count info=%d header=%d",
         path, vinfo["nframes"], nframes)
     vinfo["nframes"] = max(nframes, vinfo["nframes"])
 
+def format_webp_description(path, *args, **kwargs):
+  "Describe a single WebP file, returning the text describe mode prints"
+  vinfo = get_webp_info(path, use_webpmux=kwargs.get("use_webpmux", False))
+  # Decoding every frame is only needed if webpmux didn't tell us enough
+  if not webp_info_complete(vinfo):
+    reconcile_webp_info(path, vinfo)
+
   if kwargs.get("json"):
     jargs = {}
     if kwargs.get("indent"):
       jargs["sort_keys"] = True
       jargs["indent"] = kwargs["indent"]
-    result = json.dumps(vinfo, **jargs)
-    print(result)
-  else:
-    pl = "{} frame{}".format(len(images), "" if len(images) == 1 else "s")
-    print("{}: {}".format(path, pl))
-    isize = images[0].getbbox() # assume all images have the same size
-    print("Size: {}x{}".format(isize[2], isize[3]))
+    return json.dumps(vinfo, **jargs)
+  nframes = vinfo["nframes"]
+  pl = "{} frame{}".format(nframes, "" if nframes == 1 else "s")
+  return "{}: {}\nSize: {}x{}".format(path, pl, *vinfo["size"])
+
+def describe_webp_file(path, *args, **kwargs):
+  "Display information about a single WebP file"
+  print(format_webp_description(path, *args, **kwargs))
 
 def describe_webp_files(paths, *args, **kwargs):
   "Display information about WebP files"
-  for path in paths:
-    describe_webp_file(path, *args, **kwargs)
+  if len(paths) < 2:
+    for path in paths:
+      describe_webp_file(path, *args, **kwargs)
+    return
+
+  def describe(path):
+    "Describe one file with the shared arguments"
+    return format_webp_description(path, *args, **kwargs)
 
-def create_webp_file(images, output_path, fps=None):
-  "Create a WebP file from the given images"
-  kwargs = {}
-  if fps is not None:
-    kwargs["fps"] = fps
+  # Files are described concurrently; map() keeps the output in input order
+  with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as pool:
+    for result in pool.map(describe, paths):
+      print(result)
+
+def create_webp_file(images, output_path, fps=None, quality=None,
+                     method=None, lossless=False):
+  """
+  Create an animated WebP file from the given iterable of images. The
+  quality, method, and lossless arguments configure libwebp; None uses
+  libwebp's defaults.
+  """
+  import webp # pylint: disable=import-outside-toplevel
+  images = iter(images)
+  first = next(images, None)
+  if first is None:
+    raise ValueError("no images to save to {}".format(output_path))
+  if fps is None:
+    fps = DEFAULT_WEBP_FPS
   logger.debug("Saving images to %s...", output_path)
-  webp.save_images(images, output_path, **kwargs)
+  config = webp.WebPConfig.new(quality=quality, method=method,
+      lossless=lossless)
+  encoder = webp.WebPAnimEncoder.new(*first.size)
+  # Convert one frame at a time; the encoder copies what it needs, so only
+  # a single WebPPicture is alive rather than one per frame
+  nframes = 0
+  for image in itertools.chain((first,), images):
+    picture = webp.WebPPicture.from_pil(image)
+    encoder.encode_frame(picture, round(nframes * 1000 / fps), config)
+    del picture
+    nframes += 1
+  anim_data = encoder.assemble(round(nframes * 1000 / fps))
+  with open(output_path, "wb") as fobj:
+    fobj.write(anim_data.buffer())
 
 def extract_webp_file(images, oformat):
   "Extract WebP file(s) to files given by the output format"
-  results = []
-  for image_index, image in enumerate(images):
-    # TODO: add extra fields if desired
-    bounds = image.getbbox()
-    width, height = bounds[2], bounds[3]
-    kwds = {
-      "index": image_index,
-      "frame": image_index,
-      "n": image_index + 1,
-      "w": width,
-      "width": width,
-      "h": height,
-      "height": height
-    }
-    image_filename = format_extract_filename(oformat, image_index+1, **kwds)
+  def save_image(image, image_filename):
+    # pylint: disable=missing-function-docstring
     image.save(image_filename)
-    logger.debug("Generated %s", image_filename)
-    results.append(image_filename)
+    return image_filename
+
+  results = []
+  pending = collections.deque()
+  # Pillow releases the GIL while encoding, so the frames save in parallel;
+  # only a window of frames is held so the input can be a stream
+  with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as pool:
+    for image_index, image in enumerate(images):
+      # TODO: add extra fields if desired
+      width, height = image.size
+      kwds = {
+        "index": image_index,
+        "frame": image_index,
+        "n": image_index + 1,
+        "w": width,
+        "width": width,
+        "h": height,
+        "height": height
+      }
+      image_filename = format_extract_filename(oformat, image_index+1, **kwds)
+      results.append(image_filename)
+      pending.append(pool.submit(save_image, image, image_filename))
+      if len(pending) > 2 * MAX_WORKERS:
+        logger.debug("Generated %s", pending.popleft().result())
+    while pending:
+      logger.debug("Generated %s", pending.popleft().result())
   return results
 
 def main():
@@ -311,7 +686,7 @@ This is done if the output path ends in ".webp".
   ag = ap.add_argument_group("mode")
   mg = ag.add_mutually_exclusive_group()
   mg.add_argument("-m", "--mode",
-      choices=(MODE_DESCRIBE, MODE_CREATE, MODE_EXTRACT),
+      choices=(MODE_DESCRIBE, MODE_CREATE, MODE_EXTRACT, MODE_ENCODE),
       help="explicitly configure execution mode rather than deducing")
   mg.add_argument("-d", "--describe", action="store_const",
       dest="mode", const=MODE_DESCRIBE, help="Shorthand for --mode=%(const)s")
@@ -324,6 +699,19 @@ This is done if the output path ends in ".webp".
       help="format output as JSON")
   ag.add_argument("--indent", type=int,
       help="indent JSON with %(metavar)s spaces")
+  ag.add_argument("--use-webpmux", action="store_true",
+      help="describe files using webpmux -info instead of reading them")
+  ag.add_argument("--fps", type=float,
+      help="frames per second when creating a WebP image or video")
+  ag.add_argument("--quality", type=float, metavar="Q",
+      help="WebP quality factor, 0 (small) to 100 (best)")
+  ag.add_argument("--method", type=int, choices=range(7), metavar="M",
+      help="WebP compression method, 0 (fast) to 6 (small)")
+  ag.add_argument("--lossless", action="store_true",
+      help="create a lossless WebP image")
+  ag.add_argument("--encoder", default=DEFAULT_ENCODER,
+      help="video FourCC, or %r to encode with ffmpeg's h264_nvenc"
+           " (default: %%(default)s)" % (ENCODER_NVENC,))
   ag = ap.add_argument_group("diagnostics")
   mg = ag.add_mutually_exclusive_group()
   mg.add_argument("-q", "--quiet", action="store_true",
@@ -346,12 +734,14 @@ This is done if the output path ends in ".webp".
     ap.error("Nothing to process; exiting")
   logger.debug("Scanning %d file(s)", len(paths))
 
+  mask = webp_mask(paths)
   mode = args.mode
   if mode is None:
-    mode = deduce_mode(paths, args.output)
+    mode = deduce_mode(paths, args.output, mask)
 
   if mode == MODE_DESCRIBE:
-    describe_webp_files(paths, json=args.json, indent=args.indent)
+    describe_webp_files(paths, json=args.json, indent=args.indent,
+        use_webpmux=args.use_webpmux)
     # for path in paths:
     #   vinfo = get_webp_info(path)
     #   logger.debug(vinfo)
@@ -374,12 +764,13 @@ This is done if the output path ends in ".webp".
     #            " {image_size}b"
     #            " {compression}").format(**frame))
   elif mode == MODE_CREATE:
-    images = load_images(paths)
+    images = iter_images(paths, mask)
     opath = deduce_create_output(args.output)
     logger.info("Creating WebP file %s", opath)
-    create_webp_file(images, opath, fps=args.fps)
+    create_webp_file(images, opath, fps=args.fps, quality=args.quality,
+        method=args.method, lossless=args.lossless)
   elif mode == MODE_EXTRACT:
-    images = load_images(paths)
+    images = iter_images(paths, mask)
     oformat = deduce_extract_output(args.output)
     logger.info("Extracting WebP frames to %s", oformat)
     extract_webp_file(images, oformat)
@@ -388,7 +779,13 @@ This is done if the output path ends in ".webp".
       ap.error("This mode requires an output path")
     if os.path.isdir(args.output):
       ap.error("{}: is a directory".format(args.output))
-    write_video(paths, args.output, fps=args.fps)
+    fps = args.fps if args.fps is not None else 24
+    if any(mask):
+      # WebP frames are already decoded; encode them without a round-trip
+      images = iter_images(paths, mask)
+      write_video_from_pil(images, args.output, fps=fps, encoder=args.encoder)
+    else:
+      write_video(paths, args.output, fps=fps, encoder=args.encoder)
   else:
     ap.error("Failed to deduce mode; please specify")
 